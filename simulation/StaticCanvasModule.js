@@ -0,0 +1,80 @@
+// Canvas grid that keeps the static terrain on its own canvas.
+// The server only sends the static layers when the model changes, every other frame
+// only redraws the dynamic layers (cars and stoplights) on the canvas above it.
+const StaticCanvasModule = function (
+  canvas_width,
+  canvas_height,
+  grid_width,
+  grid_height
+) {
+  const createElement = (tagName, attrs) => {
+    const element = document.createElement(tagName);
+    Object.assign(element, attrs);
+    return element;
+  };
+
+  const parent = createElement("div", {
+    style: `height:${canvas_height}px;`,
+    className: "world-grid-parent",
+  });
+
+  // stacked with absolute positioning: terrain, agents, interactions
+  const createCanvas = () => {
+    const el = createElement("canvas", {
+      width: canvas_width,
+      height: canvas_height,
+      className: "world-grid",
+    });
+    return el;
+  };
+  const staticCanvas = createCanvas();
+  const canvas = createCanvas();
+  const interaction_canvas = createCanvas();
+
+  parent.appendChild(staticCanvas);
+  parent.appendChild(canvas);
+  parent.appendChild(interaction_canvas);
+
+  const elements = document.getElementById("elements");
+  elements.appendChild(parent);
+
+  const interactionHandler = new InteractionHandler(
+    canvas_width,
+    canvas_height,
+    grid_width,
+    grid_height,
+    interaction_canvas.getContext("2d")
+  );
+  const staticDraw = new GridVisualization(
+    canvas_width,
+    canvas_height,
+    grid_width,
+    grid_height,
+    staticCanvas.getContext("2d"),
+    null
+  );
+  const canvasDraw = new GridVisualization(
+    canvas_width,
+    canvas_height,
+    grid_width,
+    grid_height,
+    canvas.getContext("2d"),
+    interactionHandler
+  );
+
+  this.render = (data) => {
+    if (data.static) {
+      staticDraw.resetCanvas();
+      for (const layer in data.static) staticDraw.drawLayer(data.static[layer]);
+      staticDraw.drawGridLines("#eee");
+    }
+
+    canvasDraw.resetCanvas();
+    for (const layer in data.dynamic) canvasDraw.drawLayer(data.dynamic[layer]);
+  };
+
+  this.reset = () => {
+    staticDraw.resetCanvas();
+    canvasDraw.resetCanvas();
+  };
+};
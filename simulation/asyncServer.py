@@ -0,0 +1,98 @@
+# Async ASGI server to interact with Unity, exposes the same endpoints as server.py.
+# Model steps and payload encoding run in a worker thread so the event loop keeps serving requests,
+# responses can be json, msgpack or packed structs (see trafficAgents/payloads.py) and big ones are gzipped.
+# Needs starlette, uvicorn and python-multipart, msgpack is optional.
+# Run it with: python asyncServer.py
+
+import asyncio
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+
+from trafficAgents.model import TrafficModel
+from trafficAgents import payloads
+
+trafficModel = None
+currentStep = 0
+
+# the model is not thread safe, so steps and reads are serialized
+modelLock = asyncio.Lock()
+
+
+async def runLocked(function, *args):
+    """
+    Runs function in a worker thread while holding the model lock.
+    """
+    async with modelLock:
+        return await asyncio.to_thread(function, *args)
+
+
+async def respond(request, build, packed=True):
+    """
+    Builds the payload for the negotiated media type off the event loop and wraps it in a response.
+    Responses without a packed struct layout (packed=False) are sent as json when binary is asked for.
+    """
+    mediaType = payloads.negotiate(request.headers.get("accept"), request.query_params.get("format"))
+    if mediaType == payloads.BINARY and not packed:
+        mediaType = payloads.JSON
+
+    body = await runLocked(build, mediaType)
+    return Response(body, media_type=mediaType)
+
+
+async def initModel(request):
+    global currentStep, trafficModel
+
+    form = await request.form()
+    timeToSpawn = int(form.get('timeToSpawn'))
+    spawnAmount = int(form.get('spawnAmount'))
+    sendsData = form.get('sendsData') == "True"
+
+    async with modelLock:
+        currentStep = 0
+        trafficModel = await asyncio.to_thread(TrafficModel, timeToSpawn, spawnAmount, sendsData, False)
+
+    return Response(payloads.encodeObject({"message": "Parameters recieved, model initiated."}, payloads.JSON), media_type=payloads.JSON)
+
+
+async def getCarPositions(request):
+    return await respond(request, lambda mediaType: payloads.encodeCars(payloads.carPositions(trafficModel), mediaType))
+
+
+async def getFinishedCars(request):
+    return await respond(request, lambda mediaType: payloads.encodeCars(payloads.finishedCars(trafficModel), mediaType))
+
+
+async def getStopLights(request):
+    return await respond(request, lambda mediaType: payloads.encodeStopLights(payloads.stopLights(trafficModel), mediaType))
+
+
+async def updateModel(request):
+    def step(mediaType):
+        global currentStep
+        trafficModel.step()
+        currentStep += 1
+        return payloads.encodeObject({'message': f'Model updated to step {currentStep}.', 'currentStep': currentStep}, mediaType)
+
+    return await respond(request, step, packed=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/init', initModel, methods=['POST']),
+        Route('/carPositions', getCarPositions, methods=['GET']),
+        Route('/finishedCars', getFinishedCars, methods=['GET']),
+        Route('/update', updateModel, methods=['GET']),
+        Route('/stopLightStatus', getStopLights, methods=['GET']),
+    ],
+    # small responses are not worth compressing
+    middleware=[Middleware(GZipMiddleware, minimum_size=1024)],
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host="localhost", port=8585)
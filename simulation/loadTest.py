@@ -0,0 +1,223 @@
+# Load generator that emulates Unity clients (ModelController.cs) against a local server.
+# Every client posts /init, then every timeToUpdate seconds it calls /update followed by
+# /carPositions, /finishedCars and /stopLightStatus, like the Unity coroutines do.
+# Reports latency percentiles per endpoint, request throughput and model step rate.
+# Runs offline: with --serve the server module is started in this process on a free port.
+#
+# Examples, from the simulation folder:
+#   python loadTest.py --serve server --clients 4 --ticks 50 --timeToUpdate 0.1
+#   python loadTest.py --url http://localhost:8585 --clients 8 --initOnce
+#   python loadTest.py --serve asyncServer --maxP99 50 --output results.json
+# The exit code is 1 if there were more errors than --maxErrors (0 by default) or the p99 is over --maxP99.
+
+import argparse
+import http.client
+import importlib
+import json
+import math
+import socket
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+ENDPOINTS = ['/init', '/update', '/carPositions', '/finishedCars', '/stopLightStatus']
+
+
+def percentile(values, p):
+    """
+    Returns the p percentile (0 to 100) of the values, using the nearest rank.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def serve(moduleName):
+    """
+    Imports the server module and serves its app in a background thread on a free port, returns the url.
+    Flask apps are served with werkzeug, anything else is assumed to be an ASGI app and served with uvicorn.
+    """
+    app = importlib.import_module(moduleName).app
+
+    if hasattr(app, 'wsgi_app'):
+        from werkzeug.serving import make_server
+
+        server = make_server('localhost', 0, app, threaded=True)
+        port = server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        import uvicorn
+
+        # find a free port for uvicorn to bind
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+
+        server = uvicorn.Server(uvicorn.Config(app, host='localhost', port=port, log_level='warning'))
+        threading.Thread(target=server.run, daemon=True).start()
+
+        while not server.started:
+            time.sleep(0.01)
+
+    return f'http://localhost:{port}'
+
+
+class UnityClient(threading.Thread):
+    """
+    Simulated renderer, follows the request pattern of ModelController.cs.
+    Args:
+        url: base url of the server
+        ticks: updates to request
+        timeToUpdate: seconds between updates
+        params: form sent to /init, or None to skip /init
+        initDone: event set once the model exists, clients that don't init wait for it
+    """
+    def __init__(self, url, ticks, timeToUpdate, params, initDone):
+        super().__init__(daemon=True)
+        self.url = urlsplit(url)
+        self.ticks = ticks
+        self.timeToUpdate = timeToUpdate
+        self.params = params
+        self.initDone = initDone
+
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = 0
+        self.steps = 0
+
+    def request(self, method, endpoint, body=None):
+        """
+        Sends a request and records its latency, returns the parsed json or None if it failed.
+        Failed requests count as errors and are kept out of the latencies.
+        """
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, endpoint, body=body, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.errors += 1
+            # start over with a new connection
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(self.url.hostname, self.url.port)
+            return None
+
+        if response.status != 200:
+            self.errors += 1
+            return None
+
+        self.latencies[endpoint].append(time.perf_counter() - start)
+
+        return json.loads(data) if data else None
+
+    def run(self):
+        self.connection = http.client.HTTPConnection(self.url.hostname, self.url.port)
+
+        if self.params is not None:
+            self.request('POST', '/init', urlencode(self.params))
+            self.initDone.set()
+        else:
+            self.initDone.wait()
+
+        self.request('GET', '/carPositions')
+
+        nextTick = time.perf_counter() + self.timeToUpdate
+        for _ in range(self.ticks):
+            time.sleep(max(0, nextTick - time.perf_counter()))
+            nextTick += self.timeToUpdate
+
+            if self.request('GET', '/update') is not None:
+                self.steps += 1
+                self.request('GET', '/carPositions')
+                self.request('GET', '/finishedCars')
+                self.request('GET', '/stopLightStatus')
+
+        self.connection.close()
+
+
+def runLoadTest(url, clients=4, ticks=50, timeToUpdate=0.1, timeToSpawn=1, spawnAmount=4, initOnce=False):
+    """
+    Runs the simulated clients against the server and returns the report.
+    """
+    params = {'timeToSpawn': timeToSpawn, 'spawnAmount': spawnAmount, 'sendsData': 'False'}
+    initDone = threading.Event()
+
+    workers = [UnityClient(url, ticks, timeToUpdate, params if i == 0 or not initOnce else None, initDone) for i in range(clients)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    report = {'clients': clients, 'ticks': ticks, 'timeToUpdate': timeToUpdate, 'elapsed': elapsed, 'endpoints': {}}
+
+    allLatencies = []
+    for endpoint in ENDPOINTS:
+        latencies = [latency for worker in workers for latency in worker.latencies[endpoint]]
+        allLatencies.extend(latencies)
+
+        report['endpoints'][endpoint] = {
+            'requests': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+        }
+
+    # successful requests, the failed ones are in errors
+    report['requests'] = len(allLatencies)
+    report['errors'] = sum(worker.errors for worker in workers)
+    report['throughput'] = len(allLatencies) / elapsed
+    report['stepRate'] = sum(worker.steps for worker in workers) / elapsed
+    report['p99'] = percentile(allLatencies, 99)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Emulate Unity clients against a local traffic server.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://localhost:8585", help="server that is already running")
+    target.add_argument("--serve", help="server module to start in this process, e.g. server or asyncServer")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--ticks", type=int, default=50)
+    parser.add_argument("--timeToUpdate", type=float, default=0.1)
+    parser.add_argument("--timeToSpawn", type=int, default=1)
+    parser.add_argument("--spawnAmount", type=int, default=4)
+    parser.add_argument("--initOnce", action="store_true", help="only the first client posts /init, the rest share its model")
+    parser.add_argument("--maxP99", type=float, help="fail (exit code 1) if the p99 latency in milliseconds is higher")
+    parser.add_argument("--maxErrors", type=int, default=0, help="fail (exit code 1) if more requests than this fail")
+    parser.add_argument("--output", help="write the report as json to this file")
+    args = parser.parse_args()
+
+    url = serve(args.serve) if args.serve else args.url
+
+    report = runLoadTest(url, args.clients, args.ticks, args.timeToUpdate, args.timeToSpawn, args.spawnAmount, args.initOnce)
+
+    print(f"{report['requests']} requests in {report['elapsed']:.2f}s, {report['errors']} errors")
+    print(f"throughput: {report['throughput']:.1f} requests/s, step rate: {report['stepRate']:.1f} steps/s")
+    for endpoint, stats in report['endpoints'].items():
+        if stats['requests']:
+            print(f"{endpoint}: {stats['requests']} requests, p50 {stats['p50'] * 1000:.1f}ms, p90 {stats['p90'] * 1000:.1f}ms, p99 {stats['p99'] * 1000:.1f}ms, max {stats['max'] * 1000:.1f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    failed = False
+    if report['errors'] > args.maxErrors:
+        print(f"{report['errors']} requests failed, the limit is {args.maxErrors}")
+        failed = True
+
+    if args.maxP99 is not None and (report['p99'] is None or report['p99'] * 1000 > args.maxP99):
+        print(f"p99 latency is over {args.maxP99}ms")
+        failed = True
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,95 @@
+# Python flask server that replays a recorded run to Unity, with the same endpoints as server.py.
+# Record a run with: python -m trafficAgents.trajectory run.traj
+# Then replay it with: python replayServer.py run.traj
+# /seek?step=N jumps to any step of the recording. Unity only removes the cars listed by /finishedCars,
+# so after a jump the next /finishedCars also lists the cars of the old step that are not in the new one.
+
+import sys
+
+from flask import Flask, request, jsonify, Response
+from trafficAgents.trajectory import TrajectoryReader
+from trafficAgents import payloads
+
+trajectory = None
+currentStep = 0
+# cars that Unity still shows from before a jump, reported by the next /finishedCars
+leftBehind = set()
+
+app = Flask("Traffic replay")
+
+
+def respond(body, mediaType):
+    return Response(body, mimetype=mediaType)
+
+
+def negotiate():
+    return payloads.negotiate(request.headers.get("Accept"), request.args.get("format"))
+
+
+def jump(step):
+    """
+    Moves the replay to the step, remembering the cars of the current step so Unity removes them.
+    """
+    global currentStep
+
+    leftBehind.update(carID for carID, x, z in trajectory.frame(currentStep).cars)
+    currentStep = step
+
+
+@app.route('/init', methods=['POST'])
+def initModel():
+    # the parameters are fixed by the recording, so init only rewinds it
+    jump(0)
+
+    return jsonify({"message": "Parameters recieved, replay rewound.", "params": trajectory.header["params"], "frames": len(trajectory)})
+
+
+@app.route('/carPositions', methods=['GET'])
+def getCarPositions():
+    mediaType = negotiate()
+    return respond(payloads.encodeCars(trajectory.frame(currentStep).cars, mediaType), mediaType)
+
+
+@app.route('/finishedCars', methods=['GET'])
+def getFinishedCars():
+    mediaType = negotiate()
+    frame = trajectory.frame(currentStep)
+    
+    # cars from before a jump that are not on the road anymore
+    onRoad = {carID for carID, x, z in frame.cars}
+    removed = set(frame.finished) | (leftBehind - onRoad)
+    leftBehind.clear()
+    
+    finishedCars = [(carID, 0, 0) for carID in sorted(removed)]
+    return respond(payloads.encodeCars(finishedCars, mediaType), mediaType)
+
+
+@app.route('/update', methods=['GET'])
+def updateModel():
+    global currentStep
+
+    # stay on the last frame once the recording ends
+    currentStep = min(currentStep + 1, len(trajectory) - 1)
+    return jsonify({'message': f'Model updated to step {currentStep}.', 'currentStep': currentStep})
+
+
+@app.route('/seek', methods=['GET', 'POST'])
+def seek():
+    try:
+        step = int(request.values.get('step', 0))
+    except ValueError:
+        return jsonify({'message': 'step must be an integer.'}), 400
+    
+    jump(max(0, min(step, len(trajectory) - 1)))
+    return jsonify({'message': f'Replay moved to step {currentStep}.', 'currentStep': currentStep})
+
+
+@app.route('/stopLightStatus', methods=['GET'])
+def getStopLights():
+    mediaType = negotiate()
+    return respond(payloads.encodeStopLights(trajectory.frame(currentStep).stoplights, mediaType), mediaType)
+
+
+if __name__=='__main__':
+    trajectory = TrajectoryReader(sys.argv[1])
+    app.run(host="localhost", port=8585)
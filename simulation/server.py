@@ -2,7 +2,10 @@
 # Python flask server to interact with Unity. Based on the code provided by Sergio Ruiz.
 # Octavio Navarro. October 2023git 
 
-from flask import Flask, request, jsonify
+import threading
+import time
+
+from flask import Flask, request, jsonify, Response
 from trafficAgents.model import TrafficModel
 from trafficAgents.agent import CarAgent, StoplightAgent
 
@@ -12,6 +15,11 @@ spawnAmount = 4 # max 4
 trafficModel = None
 currentStep = 0
 
+# the dev server is threaded, and background jobs step the model too
+modelLock = threading.Lock()
+# background "run until step N" job, see /runUntil
+job = None
+
 app = Flask("Traffic example")
 
 @app.route('/init', methods=['POST'])
@@ -23,9 +31,10 @@ def initModel():
         spawnAmount = int(request.form.get('spawnAmount'))
         sendsData = request.form.get('sendsData') == "True"
         
-        currentStep = 0
+        with modelLock:
+            currentStep = 0
 
-        trafficModel = TrafficModel(timeToSpawn, spawnAmount, sendsData)
+            trafficModel = TrafficModel(timeToSpawn, spawnAmount, sendsData)
 
         return jsonify({"message":"Parameters recieved, model initiated."})
 
@@ -34,7 +43,9 @@ def getCarPositions():
     global trafficModel
 
     if request.method == 'GET':
-        agentPositions = [{"id": str(a.unique_id), "x": a.pos[0], "y":1, "z": a.pos[1]} for a in trafficModel.schedule.agents if isinstance(a, CarAgent)]
+        # background jobs step the model, so read it under the lock
+        with modelLock:
+            agentPositions = [{"id": str(a.unique_id), "x": a.pos[0], "y":1, "z": a.pos[1]} for a in trafficModel.schedule.agents if isinstance(a, CarAgent)]
 
         return jsonify({'positions':agentPositions})
     
@@ -43,29 +54,256 @@ def getFinishedCars():
     global trafficModel
 
     if request.method == 'GET':
-        finishedCars = [{"id": str(carID), "x": 0, "y":1, "z": 0} for carID in trafficModel.finishedCars]
+        with modelLock:
+            finishedCars = [{"id": str(carID), "x": 0, "y":1, "z": 0} for carID in trafficModel.finishedCars]
         print(finishedCars)
 
         return jsonify({'positions':finishedCars})
 
 
+def runSteps(steps, budget=None, finishedCars=None):
+    """
+    Advances the model up to the given number of steps, or until budget seconds have passed,
+    with the model's output suppressed. Returns the aggregate counters of the run.
+    finishedCars is a list to add the finished cars to, so runs split in batches report all of them.
+    """
+    global currentStep
+
+    start = time.perf_counter()
+    finishedBefore = trafficModel.totalFinishedCount
+    spawnedBefore = trafficModel.carCount
+    
+    # cars that finish in any of the steps, Unity has to remove all of them, not only the last step's
+    if finishedCars is None:
+        finishedCars = []
+
+    verbose = trafficModel.verbose
+    trafficModel.verbose = False
+    
+    stepsRun = 0
+    while stepsRun < steps and trafficModel.running:
+        if budget is not None and time.perf_counter() - start >= budget:
+            break
+
+        trafficModel.step()
+        finishedCars.extend(trafficModel.finishedCars)
+        currentStep += 1
+        stepsRun += 1
+    
+    trafficModel.verbose = verbose
+    trafficModel.finishedCars = finishedCars
+
+    return {
+        'stepsRun': stepsRun,
+        'elapsed': time.perf_counter() - start,
+        'carsSpawned': trafficModel.carCount - spawnedBefore,
+        'carsFinished': trafficModel.totalFinishedCount - finishedBefore,
+        'carsOnRoad': len([a for a in trafficModel.schedule.agents if isinstance(a, CarAgent)]),
+        'totalFinishedCars': trafficModel.totalFinishedCount,
+        'running': trafficModel.running,
+    }
+
 @app.route('/update', methods=['GET'])
 def updateModel():
     global currentStep, trafficModel
     if request.method == 'GET':
-        trafficModel.step()
-        currentStep += 1
-        print("step: ", currentStep)
-        return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
+        try:
+            steps = int(request.args.get('steps', 1))
+            budget = request.args.get('budget')
+            budget = float(budget) if budget is not None else None
+        except ValueError:
+            return jsonify({'message': 'steps must be an integer and budget a number of seconds.'}), 400
+        
+        if steps < 1 or (budget is not None and budget <= 0):
+            return jsonify({'message': 'steps and budget must be positive.'}), 400
+        
+        if job is not None and job.is_alive():
+            return jsonify({'message': 'A background job is running the model.', 'currentStep': currentStep}), 409
+
+        with modelLock:
+            # a single step keeps the original behavior, which Unity uses every tick
+            if steps == 1 and budget is None:
+                trafficModel.step()
+                currentStep += 1
+                print("step: ", currentStep)
+                return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
+
+            counters = runSteps(steps, budget)
+            
+            return jsonify({
+                'message': f'Model updated to step {currentStep}.',
+                'currentStep': currentStep,
+                **counters,
+                'positions': [{"id": str(a.unique_id), "x": a.pos[0], "y":1, "z": a.pos[1]} for a in trafficModel.schedule.agents if isinstance(a, CarAgent)],
+                'stopLights': [{"id": str(a.pos[0]) + "," + str(a.pos[1]), "x": a.pos[0], "y":1, "z": a.pos[1], "color": a.color, "direction": a.direction} for a in trafficModel.schedule.agents if isinstance(a, StoplightAgent)],
+            })
+
+class RunUntilJob(threading.Thread):
+    """
+    Background job that advances the model until the target step, in small batches so the
+    other endpoints can read the model while it runs.
+    """
+    def __init__(self, model, target, batchSize=50):
+        super().__init__(daemon=True)
+        self.model = model
+        self.target = target
+        self.batchSize = batchSize
+        self.startStep = currentStep
+        self.started = time.perf_counter()
+        self.finished = None
+        self.cancelled = False
+        self.counters = None
+        # cars finished in every batch, the model reports them all once the job ends
+        self.finishedCars = []
+    
+    def run(self):
+        while not self.cancelled:
+            with modelLock:
+                # the model was replaced through /init, or it stopped on its own
+                if trafficModel is not self.model or currentStep >= self.target or not self.model.running:
+                    break
+                
+                counters = runSteps(min(self.batchSize, self.target - currentStep), finishedCars=self.finishedCars)
+                
+            if self.counters is None:
+                self.counters = counters
+            else:
+                for key in ['stepsRun', 'elapsed', 'carsSpawned', 'carsFinished']:
+                    self.counters[key] += counters[key]
+                for key in ['carsOnRoad', 'totalFinishedCars', 'running']:
+                    self.counters[key] = counters[key]
+        
+        self.finished = time.perf_counter()
+    
+    def status(self):
+        total = self.target - self.startStep
+        return {
+            'running': self.is_alive(),
+            'cancelled': self.cancelled,
+            'currentStep': currentStep,
+            'targetStep': self.target,
+            'progress': 1 if total <= 0 else min(1, (currentStep - self.startStep) / total),
+            'elapsed': (self.finished or time.perf_counter()) - self.started,
+            'counters': self.counters,
+        }
+
+@app.route('/runUntil', methods=['POST'])
+def runUntil():
+    global job
+
+    if job is not None and job.is_alive():
+        return jsonify({'message': 'A background job is already running.', **job.status()}), 409
+
+    try:
+        target = int(request.values['step'])
+    except (KeyError, ValueError):
+        return jsonify({'message': 'step must be given as an integer.'}), 400
+    
+    job = RunUntilJob(trafficModel, target)
+    job.start()
+    
+    return jsonify({'message': f'Running the model until step {job.target}.', **job.status()})
+
+@app.route('/jobStatus', methods=['GET'])
+def getJobStatus():
+    if job is None:
+        return jsonify({'message': 'No background job has been started.'}), 404
+    
+    return jsonify(job.status())
+
+@app.route('/cancelJob', methods=['POST'])
+def cancelJob():
+    if job is None:
+        return jsonify({'message': 'No background job has been started.'}), 404
+    
+    job.cancelled = True
+    job.join()
+    return jsonify(job.status())
 
 @app.route('/stopLightStatus', methods=['GET'])
 def getStopLights():
     global trafficModel
 
     if request.method == 'GET':
-        stoplights = [{"id": str(a.pos[0]) + "," + str(a.pos[1]), "x": a.pos[0], "y":1, "z": a.pos[1], "color": a.color, "direction": a.direction} for a in trafficModel.schedule.agents if isinstance(a, StoplightAgent)]
+        with modelLock:
+            stoplights = [{"id": str(a.pos[0]) + "," + str(a.pos[1]), "x": a.pos[0], "y":1, "z": a.pos[1], "color": a.color, "direction": a.direction} for a in trafficModel.schedule.agents if isinstance(a, StoplightAgent)]
+        
         return jsonify({'stopLights':stoplights})
 
+@app.route('/heatmap', methods=['GET'])
+def getHeatmap():
+    global trafficModel
+
+    if request.method == 'GET':
+        if trafficModel.congestion is None:
+            return jsonify({'message': 'Congestion tracking is disabled for this model.'}), 404
+        
+        view = request.args.get('view', 'cumulative')
+        if view not in ['cumulative', 'window']:
+            return jsonify({'message': f'Unknown view {view}, use cumulative or window.'}), 400
+
+        with modelLock:
+            # the npz export has both views
+            if request.args.get('format') == 'npz':
+                return Response(trafficModel.congestion.exportBytes(), mimetype='application/octet-stream', headers={'Content-Disposition': 'attachment; filename=heatmap.npz'})
+            
+            return jsonify(trafficModel.congestion.heatmap(view))
+
+@app.route('/closures', methods=['GET', 'POST'])
+def closures():
+    """
+    GET returns the closed cells and blocked edges.
+    POST takes json like {"action": "close", "cells": [[x, z]], "lanes": [{"from": "1", "to": "15", "lane": 0}], "edges": [["1", "15"]]},
+    action is "close" or "reopen", and returns the new closures and how many cars were rerouted.
+    """
+    global trafficModel
+
+    if request.method == 'GET':
+        with modelLock:
+            return jsonify({'closedCells': sorted(trafficModel.closedCells), 'closedEdges': sorted(trafficModel.closedEdges), 'blockedEdges': sorted(trafficModel.blockedEdges)})
+    
+    data = request.get_json()
+    action = data.get('action', 'close')
+    if action not in ['close', 'reopen']:
+        return jsonify({'message': f'Unknown action {action}, use close or reopen.'}), 400
+    
+    closing = action == 'close'
+    cells = data.get('cells') or []
+    lanes = data.get('lanes') or []
+    edges = data.get('edges') or []
+    
+    with modelLock:
+        # check everything first, so an invalid closure doesn't leave the ones before it applied
+        try:
+            cells = [tuple(cell) for cell in cells]
+            trafficModel.checkCells(cells)
+            
+            lanes = [(lane['from'], lane['to'], lane['lane']) for lane in lanes]
+            for lane in lanes:
+                trafficModel.checkLane(*lane)
+            
+            edges = [tuple(edge) for edge in edges]
+            for edge in edges:
+                if len(edge) != 2:
+                    raise ValueError(f"Edge {list(edge)} is not a pair of nodes")
+                trafficModel.checkEdge(*edge)
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'message': f'Invalid closure: {e}'}), 400
+        
+        results = []
+        if cells:
+            results.append(trafficModel.closeCells(cells) if closing else trafficModel.reopenCells(cells))
+        
+        for lane in lanes:
+            results.append(trafficModel.closeLane(*lane) if closing else trafficModel.reopenLane(*lane))
+        
+        for edge in edges:
+            results.append(trafficModel.closeEdge(*edge) if closing else trafficModel.reopenEdge(*edge))
+        
+        rerouted = sum(result['rerouted'] for result in results)
+        
+        return jsonify({'closedCells': sorted(trafficModel.closedCells), 'closedEdges': sorted(trafficModel.closedEdges), 'blockedEdges': sorted(trafficModel.blockedEdges), 'rerouted': rerouted})
+
 
 if __name__=='__main__':
     app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file
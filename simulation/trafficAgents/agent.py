@@ -1,46 +1,79 @@
 from queue import PriorityQueue
 from collections import deque
-from mesa import Agent
+from .core import Agent
+from .lanes import OTHER_LANE, OTHER_LANE_OFFSETS, RIGHT
 
 class CarAgent(Agent):
     """
     Agent that represents a car that moves around the grid.
-    
+    Finished cars are recycled by the model (see TrafficModel.newCar), so everything
+    that depends on the trip is set in reset and the buffers are reused.
     """
+    __slots__ = ("destination", "prevNode", "path", "laneSpeed", "lastDirection", "speedMatrix",
+                 "patienceLimit", "stationaryTime", "spawnStep", "currNode")
+    
     def __init__(self, unique_id, model, destination):
         """
         Creates a new car agent.
         Args:
+            unique_id: id of the car, car{number}
+            model: the TrafficModel
+            destination: cell the car drives to
         """
         super().__init__(unique_id, model)
+        
+        self.laneSpeed = deque()
+        
+        # speedMatrix[i][j] stores the speed the car has perceived from node i to node j
+        self.speedMatrix = [[1] * (len(self.model.nodeToCells) + 1) for _ in range(len(self.model.nodeToCells) + 1)]
+        
+        self.patienceLimit = 11
+        
+        self.reset(unique_id, destination)
+    
+    def reset(self, unique_id, destination):
+        """
+        Prepares the car for a new trip, reusing its lane speed and speed matrix buffers.
+        """
+        self.unique_id = unique_id
         self.destination = destination
         self.prevNode = None
+        self.currNode = None
         
         self.path = None
         
-        self.laneSpeed = deque([1])
+        self.resetLaneSpeed()
         
         self.lastDirection = None
         
-        # speedMatrix[i][j] stores the speed the car has perceived from node i to node j
-        self.speedMatrix = [[1] * (len(self.model.nodeToCells) + 1) for _ in range(len(self.model.nodeToCells) + 1)]
+        for row in self.speedMatrix:
+            row[:] = self.model.speedRow
         
-        self.patienceLimit = 11
         self.stationaryTime = 0
         
+        # step the car was spawned in, used to measure trip times
+        self.spawnStep = self.model.steps
+    
+    def resetLaneSpeed(self):
+        """
+        Resets the lane speed when the car changes street or lane.
+        """
+        self.laneSpeed.clear()
+        self.laneSpeed.append(1)
+        
     def step(self):
         if self.lastDirection == None:
             # get the direction of the street we are in
-            for agent in self.model.grid[self.pos[0]][self.pos[1]]:
-                if isinstance(agent, StreetAgent):
-                    self.lastDirection = agent.directions[0]
+            self.lastDirection = self.model.lanes.mainDirection.get(self.pos)
         
         # if we are in our destination, then we are done
         if self.pos == self.destination:
             self.model.schedule.remove(self)
             self.model.grid.remove_agent(self)
             self.model.finishedCars.append(self.unique_id)
-            self.model.totalFinishedCars.append(self.unique_id)
+            self.model.totalFinishedCount += 1
+            self.model.finishedTripTimes.append(self.model.steps - self.spawnStep)
+            self.model.recycleCar(self)
             return
         
         # if we are in a node
@@ -71,6 +104,14 @@ class CarAgent(Agent):
         """
         Generates a path from the current location to the destination using A*.
         """
+        # if closures leave no open route, path through them anyway and wait for them to reopen
+        if not self.findPath(self.model.openAdList) and self.model.blockedEdges:
+            self.findPath(self.model.adList)
+    
+    def findPath(self, adList):
+        """
+        A* over the given adjacency list, returns whether a path to the destination was found.
+        """
         
         # helper heuristic function
         def heuristic(n):
@@ -91,34 +132,41 @@ class CarAgent(Agent):
             # check if we are in the target node
             if node == target:
                 # reconstruct the path and return it
+                # each element is (node, direction, nextTurn), nextTurn is the first direction
+                # after this one that is different from it, so the best lane is known without walking the path
                 self.path = deque()
+                nextTurn = None
                 
                 while node != self.currNode:
-                    self.path.appendleft((cameFrom[node][0], cameFrom[node][1]))
-                    node = cameFrom[node][0]
+                    source, direction = cameFrom[node]
+                    
+                    if self.path and self.path[0][1] != direction:
+                        nextTurn = self.path[0][1]
+                    
+                    self.path.appendleft((source, direction, nextTurn))
+                    node = source
 
-                return 
+                return True
             
             # if it has no edges, and it's not the target, then it's a dead end
-            if node not in self.model.adList:
+            if node not in adList:
                 continue
             
-            for edge in self.model.adList[node]:
+            for edge in adList[node]:
                 nextN = edge["to"]
                 
                 if nextN not in cameFrom:
-                    cameFrom[nextN] = (node, edge["direction"])
+                    cameFrom[nextN] = (node, edge["code"])
                     newCost = cost + (edge["distance"] / self.speedMatrix[int(node)][int(nextN)])
                     pq.put((heuristic(nextN) + newCost, newCost, nextN))
+        
+        return False
             
     def moveWithinNode(self):
         """
         Moves the car when it's within a node.
         """
-        for agent in self.model.grid[self.pos[0]][self.pos[1]]:
-            if isinstance(agent, StreetAgent):
-                streetDirections = agent.directions
-
+        streetDirections = self.model.lanes.streetDirections[self.pos]
 
         # if it can move in the direction it's pathing towards, then move there
         if self.path[0][1] in streetDirections and self.moveToDirection(self.path[0][1]):  
@@ -133,7 +181,7 @@ class CarAgent(Agent):
                     self.currNode = self.path[0][0]
                 
                 # our lane speed also resets, since we are in a new street
-                self.laneSpeed = deque([1])
+                self.resetLaneSpeed()
         
         # as long as it's not a target node (since we know it's not a target), move with the flow to not block traffic   
         elif not self.targetNodeInDirection(streetDirections[0]) and self.moveToDirection(streetDirections[0]):
@@ -144,14 +192,13 @@ class CarAgent(Agent):
             if not (self.pos in self.model.cellToNode and self.model.cellToNode[self.pos] == self.currNode):
                 # find the new node from where we need to recalculate the path
                 # it will be the target node of the edge from current node with the direction we moved in
-                for edge in self.model.adList[self.currNode]:
-                    if edge["direction"] == streetDirections[0]:
-                        self.currNode = edge["to"]
-                        self.generatePath()
-                        break
+                nextNode = self.model.lanes.nextNode.get((self.currNode, streetDirections[0]))
+                if nextNode is not None:
+                    self.currNode = nextNode
+                    self.generatePath()
                 
                 # our lane speed also resets, since we are in a new street
-                self.laneSpeed = deque([1])
+                self.resetLaneSpeed()
                 
         else:
             self.didNotMoveCell()
@@ -162,18 +209,12 @@ class CarAgent(Agent):
         Moves the car when it's outside a node.
         """
         # check if we are in a stoplight
-        for agent in self.model.grid[self.pos[0]][self.pos[1]]:
-            if isinstance(agent, StoplightAgent):
-                if agent.color == "red":
-                    return
-                else:
-                    break
+        stoplight = self.model.lanes.stoplights.get(self.pos)
+        if stoplight is not None and stoplight.color == "red":
+            return
         
         # get the direction of the street we are in
-        streetDirection = None
-        for agent in self.model.grid[self.pos[0]][self.pos[1]]:
-            if isinstance(agent, StreetAgent):
-                streetDirection = agent.directions[0]
+        streetDirection = self.model.lanes.mainDirection.get(self.pos)
         
         if streetDirection == None:
             streetDirection = self.lastDirection
@@ -192,13 +233,11 @@ class CarAgent(Agent):
         #         self.didNotMoveCell()
         #         return
         
-        lanes = ["up", "down"] if streetDirection == "left" or streetDirection == "right" else ["left", "right"]
-        
         # lane we are in
         currentLane = self.getCurrentLane(streetDirection)
         
         # lane we are not in
-        otherLane = lanes[0] if currentLane == lanes[1] else lanes[1]
+        otherLane = OTHER_LANE[currentLane]
         
         # an obligatory lane exists if we are making a turn next node
         obligatoryLane = self.getObligatoryLane(streetDirection)
@@ -215,7 +254,7 @@ class CarAgent(Agent):
                     # if we didn't move, try to move to the other lane
                     if self.moveLane(streetDirection, otherLane):
                         # we changed lane, so our lane speed resets
-                        self.laneSpeed = deque([1])
+                        self.resetLaneSpeed()
                     else:
                         # we couldn't move
                         self.didNotMoveCell()
@@ -237,14 +276,14 @@ class CarAgent(Agent):
                         self.didNotMoveCell()
                 else:
                     # we changed lane, so our lane speed resets
-                    self.laneSpeed = deque([1])
+                    self.resetLaneSpeed()
         
         # there is an obligatory lane
         else:
             # if we are not in the obligatory lane, try to move to it
             if currentLane != obligatoryLane and self.moveLane(streetDirection, obligatoryLane):
                 # we changed lane, so our lane speed resets
-                self.laneSpeed = deque([1])
+                self.resetLaneSpeed()
             # either we are in the obligatory lane or we couldn't move to it, either way, try to move forwards
             else:
                 if self.moveToDirection(streetDirection):
@@ -261,31 +300,9 @@ class CarAgent(Agent):
         """
         Moves the car to the given lane.
         """
-        mod_x = 0
-        mod_y = 0
-        
-        if direction == "up":
-            mod_y = 1
-        elif direction == "down":
-            mod_y = -1
-        elif direction == "left":
-            mod_x = -1
-        else: # direction == "right"
-            mod_x = 1
-        
-        if lane == "up":
-            mod_y += 1
-        elif lane == "down":
-            mod_y -= 1
-        elif lane == "left":
-            mod_x -= 1
-        else: # lane == "right"
-            mod_x += 1
-            
-        targetCell = (self.pos[0] + mod_x, self.pos[1] + mod_y)
-        
+        targetCell = self.model.lanes.laneChange[self.pos][direction][lane]
 
-        if not self.isCarInCell(targetCell):
+        if not self.isCellBlocked(targetCell):
             self.model.grid.move_agent(self, targetCell)            
             return True
         
@@ -293,38 +310,16 @@ class CarAgent(Agent):
         
     
     def moveToDirection(self, direction):
-        if direction == "up":
-            targetCell = (self.pos[0], self.pos[1] + 1)
-
-        elif direction == "down":
-            targetCell = (self.pos[0], self.pos[1] - 1)
-                
-        elif direction == "left":
-            targetCell = (self.pos[0] - 1, self.pos[1])
-
-        else: # direction == "right"
-            targetCell = (self.pos[0] + 1, self.pos[1])
+        targetCell = self.model.lanes.forward[self.pos][direction]
                 
-        if not self.isCarInCell(targetCell):
+        if not self.isCellBlocked(targetCell):
             self.model.grid.move_agent(self, targetCell)
             return True
         
         return False
     
     def targetNodeInDirection(self, direction):
-        if direction == "up":
-            targetCell = (self.pos[0], self.pos[1] + 1)
-
-        elif direction == "down":
-            targetCell = (self.pos[0], self.pos[1] - 1)
-                
-        elif direction == "left":
-            targetCell = (self.pos[0] - 1, self.pos[1])
-
-        else: # direction == "right"
-            targetCell = (self.pos[0] + 1, self.pos[1])
-            
-        return any(isinstance(agent, TargetAgent) for agent in self.model.grid[targetCell[0]][targetCell[1]])
+        return self.model.lanes.forward[self.pos][direction] in self.model.lanes.targets
     
     def isCarInCell(self, cell):
         """
@@ -332,6 +327,12 @@ class CarAgent(Agent):
         """
         return any (isinstance(agent, CarAgent) for agent in self.model.grid[cell[0]][cell[1]])
     
+    def isCellBlocked(self, cell):
+        """
+        Checks if the car can't move into the given cell, because there is a car or it's closed.
+        """
+        return cell in self.model.closedCells or self.isCarInCell(cell)
+    
     def getObligatoryLane(self, streetDirection):
         """
         Returns the preferred lane of the car, based on the direction it's going and the next step in the path
@@ -349,12 +350,13 @@ class CarAgent(Agent):
         Although the car doesn't need to make a turn next node, it will eventually have to,
         so we return what that lane will be.
         """
-        for turn in self.path:
-            if turn[1] != streetDirection:
-                return turn[1]
-            
-        # we always need to make a turn to reach the destination, so this shouldn't happen
-        return None
+        node, direction, nextTurn = self.path[0]
+        
+        if direction != streetDirection:
+            return direction
+        
+        # we always need to make a turn to reach the destination, so nextTurn shouldn't be None
+        return nextTurn
                 
     def getCurrentLane(self, direction=None):
         """
@@ -363,19 +365,8 @@ class CarAgent(Agent):
         if direction == None:
             direction = self.lastDirection
         
-        if direction == "up" or direction == "down":
-            # check if the the cell to the right is a street
-            if self.pos[0] + 1 < self.model.grid.width and any(isinstance(agent, StreetAgent) or isinstance(agent, StoplightAgent) for agent in self.model.grid[self.pos[0] + 1][self.pos[1]]):
-                return "left"
-            else:
-                return "right"
-            
-        else: # direction == "left" or direction == "right"
-            # check if the the cell to the top is a street
-            if self.pos[1] + 1 < self.model.grid.height and any(isinstance(agent, StreetAgent) or isinstance(agent, StoplightAgent) for agent in self.model.grid[self.pos[0]][self.pos[1] + 1]):
-                return "down"
-            else:
-                return "up"
+        # without a direction, the lane is checked like for horizontal streets
+        return self.model.lanes.currentLane[self.pos][RIGHT if direction is None else direction]
             
     def movedCell(self):
         """
@@ -404,8 +395,7 @@ class CarAgent(Agent):
         # observe the other lane's speed from observing other cars
         currentLane = self.getCurrentLane()
         
-        laneToOtherLanePos = {"up":(0, -1), "down":(0, 1), "left":(1, 0), "right":(-1, 0)}
-        otherLanePos = laneToOtherLanePos[currentLane]
+        otherLanePos = OTHER_LANE_OFFSETS[currentLane]
         
         otherLaneSpeed = None
         for agent in self.model.grid[self.pos[0] + otherLanePos[0]][self.pos[1] + otherLanePos[1]]:
@@ -435,17 +425,17 @@ class CarAgent(Agent):
                 to = int(edge["to"])
                 
                 # the turn our lane makes
-                if edge["direction"] == currentLane:
+                if edge["code"] == currentLane:
                     self.speedMatrix[fromNode][to] = laneSpeed
                 
                 # going straightforward
-                elif edge["direction"] == self.lastDirection:
+                elif edge["code"] == self.lastDirection:
                     # if there are three turns, it's the average of the two lanes
                     if len(self.model.adList[self.currNode]) == 3:
                         self.speedMatrix[fromNode][to] = laneSpeed if otherLaneSpeed == None else (laneSpeed + otherLaneSpeed) / 2
                     # there are two turns, so it's the speed of the lane not turning
                     else:
-                        if currentLane in self.model.nodeToDirections[self.currNode]:
+                        if currentLane in self.model.nodeToDirectionCodes[self.currNode]:
                             if otherLaneSpeed != None:
                                 self.speedMatrix[fromNode][to] = otherLaneSpeed
                         else:
@@ -461,17 +451,7 @@ class CarAgent(Agent):
         """
         Returns true if the car would move into a node in the given direction.
         """
-        if direction == "up":
-            targetCell = (self.pos[0], self.pos[1] + 1)
-
-        elif direction == "down":
-            targetCell = (self.pos[0], self.pos[1] - 1)
-                
-        elif direction == "left":
-            targetCell = (self.pos[0] - 1, self.pos[1])
-
-        else: # direction == "right"
-            targetCell = (self.pos[0] + 1, self.pos[1])
+        targetCell = self.model.lanes.forward[self.pos][direction]
         
         if targetCell in self.model.cellToNode:
             return self.model.cellToNode[targetCell]
@@ -483,44 +463,25 @@ class CarAgent(Agent):
         Moves the car to a cell that is not occupied.
         """
         # if we are in a stoplight, we should wait 
-        if any(isinstance(agent, StoplightAgent) for agent in self.model.grid[self.pos[0]][self.pos[1]]):
+        if self.pos in self.model.lanes.stoplights:
             return
         
         startedInNode = self.pos in self.model.cellToNode
         
         direction = self.lastDirection
         
-        # find the street agent we are in
-        for agent in self.model.grid[self.pos[0]][self.pos[1]]:
-            if isinstance(agent, StreetAgent):
-                if len(agent.directions) == 1:
-                    direction = agent.directions[0]
+        # the street we are in
+        streetDirections = self.model.lanes.streetDirections.get(self.pos)
+        if streetDirections is not None and len(streetDirections) == 1:
+            direction = streetDirections[0]
         
         # try to move to any of the three squares in front of our direction
-        if direction == "up":
-            y = self.pos[1] + 1
-            
-            targetCells = [(x, y) for x in range(max(self.pos[0] - 1, 0), min(self.pos[0] + 2, self.model.grid.width))]
-        
-        elif direction == "down":
-            y = self.pos[1] - 1
-            
-            targetCells = [(x, y) for x in range(max(self.pos[0] - 1, 0), min(self.pos[0] + 2, self.model.grid.width))]
-        
-        elif direction == "left":
-            x = self.pos[0] - 1
-            
-            targetCells = [(x, y) for y in range(max(self.pos[1] - 1, 0), min(self.pos[1] + 2, self.model.grid.height))]
-            
-        else: # direction == "right"
-            x = self.pos[0] + 1
-            
-            targetCells = [(x, y) for y in range(max(self.pos[1] - 1, 0), min(self.pos[1] + 2, self.model.grid.height))]
+        targetCells = self.model.lanes.unstuckCells[self.pos][RIGHT if direction is None else direction]
         
         for cell in targetCells:
-            if not self.isCarInCell(cell) and cell not in self.model.destinations:
-                # check if the cell is a street or a stoplight
-                if not any(isinstance(agent, StreetAgent) for agent in self.model.grid[cell[0]][cell[1]]):
+            if not self.isCellBlocked(cell) and cell not in self.model.destinations:
+                # check if the cell is a street
+                if cell not in self.model.lanes.streets:
                     continue
                 
                 self.model.grid.move_agent(self, cell)
@@ -531,24 +492,19 @@ class CarAgent(Agent):
                     # we are no longer in a node, so our current node will be the target node of the edge in the direction we are moving in
                     if self.pos not in self.model.cellToNode:
                         # find the direction of the street we are in
-                        streetDirection = self.lastDirection
-                        for agent in self.model.grid[self.pos[0]][self.pos[1]]:
-                            if isinstance(agent, StreetAgent):
-                                streetDirection = agent.directions[0]
+                        streetDirection = self.model.lanes.mainDirection.get(self.pos, self.lastDirection)
                             
                         # find the new node from where we need to recalculate the path
-                        for edge in self.model.adList[self.currNode]:
-                            if edge["direction"] == streetDirection:
-                                self.currNode = edge["to"]
-                                self.generatePath()
-                                self.laneSpeed = deque([1])
-                                
-                                break
+                        nextNode = self.model.lanes.nextNode.get((self.currNode, streetDirection))
+                        if nextNode is not None:
+                            self.currNode = nextNode
+                            self.generatePath()
+                            self.resetLaneSpeed()
                     
                     elif self.model.cellToNode[self.pos] != self.currNode:
                         self.currNode = self.model.cellToNode[self.pos]
                         self.generatePath()
-                        self.laneSpeed = deque([1])                    
+                        self.resetLaneSpeed()
                 
                 return True
             
@@ -568,6 +524,8 @@ class StoplightAgent(Agent):
     """
     Stoplight regulates traffic flow. Can be either vertial or horizontal.
     """
+    __slots__ = ("direction", "color", "shiftIn", "timer")
+    
     def __init__(self, unique_id, model, direction):
         super().__init__(unique_id, model)
         self.direction = direction
@@ -575,6 +533,18 @@ class StoplightAgent(Agent):
         self.color = "red" if direction == "horizontal" else "green"
         self.shiftIn = 10
         self.timer = 0
+        
+    def setTiming(self, shiftIn, offset=0):
+        """
+        Sets how many steps each color lasts, and starts the stoplight as if offset steps had already passed.
+        """
+        self.shiftIn = shiftIn
+        self.color = "red" if self.direction == "horizontal" else "green"
+        self.timer = offset % shiftIn
+        
+        # every shiftIn steps the color changes
+        if (offset // shiftIn) % 2 == 1:
+            self.color = "green" if self.color == "red" else "red"
 
     def step(self):
         self.timer += 1
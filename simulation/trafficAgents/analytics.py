@@ -0,0 +1,184 @@
+"""
+Incremental congestion analytics: per cell occupancy, dwell time and vehicles passed, and
+vehicles passed per graph edge. Everything is updated as cars are placed, moved and removed
+on the grid, so the cost per step doesn't depend on the number of agents.
+"""
+import io
+
+import numpy as np
+
+from .core import MultiGrid
+
+
+class TrackedMultiGrid(MultiGrid):
+    """
+    MultiGrid that notifies its listeners when agents are placed, moved or removed.
+    Listeners implement agentPlaced(agent, pos), agentMoved(agent, oldPos, pos) and agentRemoved(agent, pos).
+    """
+    def __init__(self, width, height, torus):
+        super().__init__(width, height, torus)
+        self.listeners = []
+
+    def place_agent(self, agent, pos):
+        super().place_agent(agent, pos)
+        for listener in self.listeners:
+            listener.agentPlaced(agent, pos)
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        super().remove_agent(agent)
+        for listener in self.listeners:
+            listener.agentRemoved(agent, pos)
+
+    def move_agent(self, agent, pos):
+        # MultiGrid moves by removing and placing, which would notify twice
+        pos = self.torus_adj(pos)
+        oldPos = agent.pos
+        MultiGrid.remove_agent(self, agent)
+        MultiGrid.place_agent(self, agent, pos)
+        for listener in self.listeners:
+            listener.agentMoved(agent, oldPos, pos)
+
+
+class CongestionTracker:
+    """
+    Accumulates congestion statistics for the cars of a model. Cell arrays are indexed [y, x],
+    like the rows of the map. There is a cumulative view since the tracker was created and a
+    windowed view of the last `window` steps, kept with a ring buffer of per step increments.
+    Args:
+        model: the TrafficModel, its grid must be a TrackedMultiGrid
+        window: steps covered by the windowed view
+    """
+    def __init__(self, model, window=100):
+        self.model = model
+        self.window = window
+
+        shape = (model.grid.height, model.grid.width)
+
+        # edges in adjacency list order, the index of an edge is its position in the edge arrays
+        self.edges = [(source, edge["to"]) for source in model.adList for edge in model.adList[source]]
+        self.edgeIndex = {edge: i for i, edge in enumerate(self.edges)}
+
+        # cars in each cell right now
+        self.occupancy = np.zeros(shape, dtype=np.int32)
+
+        # cumulative car-steps (dwell) and entries per cell, and cars passed per edge
+        self.dwell = np.zeros(shape, dtype=np.int64)
+        self.entries = np.zeros(shape, dtype=np.int64)
+        self.edgePassed = np.zeros(len(self.edges), dtype=np.int64)
+
+        # increments of the step in progress
+        self.stepEntries = np.zeros(shape, dtype=np.int32)
+        self.stepEdges = np.zeros(len(self.edges), dtype=np.int32)
+
+        # increments of the last `window` steps, and their sums
+        self.ringDwell = np.zeros((window,) + shape, dtype=np.int32)
+        self.ringEntries = np.zeros((window,) + shape, dtype=np.int32)
+        self.ringEdges = np.zeros((window, len(self.edges)), dtype=np.int32)
+        self.windowDwell = np.zeros(shape, dtype=np.int64)
+        self.windowEntries = np.zeros(shape, dtype=np.int64)
+        self.windowEdges = np.zeros(len(self.edges), dtype=np.int64)
+
+        self.steps = 0
+
+        # last node each car was in, to detect when it goes through an edge
+        self.lastNode = {}
+
+        model.grid.listeners.append(self)
+
+    def enterCell(self, agent, pos):
+        self.occupancy[pos[1], pos[0]] += 1
+        self.stepEntries[pos[1], pos[0]] += 1
+
+        node = self.model.cellToNode.get(pos)
+        if node is None:
+            return
+
+        lastNode = self.lastNode.get(agent.unique_id)
+        if node != lastNode:
+            edge = self.edgeIndex.get((lastNode, node))
+            if edge is not None:
+                self.stepEdges[edge] += 1
+
+            self.lastNode[agent.unique_id] = node
+
+    def agentPlaced(self, agent, pos):
+        self.enterCell(agent, pos)
+
+    def agentMoved(self, agent, oldPos, pos):
+        self.occupancy[oldPos[1], oldPos[0]] -= 1
+        self.enterCell(agent, pos)
+
+    def agentRemoved(self, agent, pos):
+        self.occupancy[pos[1], pos[0]] -= 1
+        self.lastNode.pop(agent.unique_id, None)
+
+    def stepEnded(self):
+        """
+        Closes the current step, called by the model after all agents moved.
+        """
+        slot = self.steps % self.window
+
+        self.dwell += self.occupancy
+        self.entries += self.stepEntries
+        self.edgePassed += self.stepEdges
+
+        self.windowDwell += self.occupancy - self.ringDwell[slot]
+        self.windowEntries += self.stepEntries - self.ringEntries[slot]
+        self.windowEdges += self.stepEdges - self.ringEdges[slot]
+
+        self.ringDwell[slot] = self.occupancy
+        self.ringEntries[slot] = self.stepEntries
+        self.ringEdges[slot] = self.stepEdges
+
+        self.stepEntries[:] = 0
+        self.stepEdges[:] = 0
+        self.steps += 1
+
+    def arrays(self, view="cumulative"):
+        """
+        Returns the arrays of the given view ("cumulative" or "window") and the steps it covers.
+        """
+        if view == "window":
+            return min(self.steps, self.window), self.windowDwell, self.windowEntries, self.windowEdges
+        elif view == "cumulative":
+            return self.steps, self.dwell, self.entries, self.edgePassed
+
+        raise ValueError(f"Unknown view {view}, use cumulative or window")
+
+    def heatmap(self, view="cumulative"):
+        """
+        Returns the given view as plain lists, ready to be sent as json.
+        """
+        steps, dwell, entries, edges = self.arrays(view)
+
+        return {
+            "view": view,
+            "steps": steps,
+            "occupancy": self.occupancy.tolist(),
+            "dwell": dwell.tolist(),
+            "entries": entries.tolist(),
+            "edges": [{"from": source, "to": to, "passed": int(passed)} for (source, to), passed in zip(self.edges, edges)],
+        }
+
+    def export(self, file):
+        """
+        Writes both views to a compressed npz file, file can be a filename or a file object.
+        """
+        arrays = {"occupancy": self.occupancy, "edges": np.array(self.edges, dtype=str)}
+        for view in ["cumulative", "window"]:
+            steps, dwell, entries, edges = self.arrays(view)
+            arrays[f"{view}_steps"] = steps
+            arrays[f"{view}_dwell"] = dwell
+            arrays[f"{view}_entries"] = entries
+            arrays[f"{view}_edges"] = edges
+
+        np.savez_compressed(file, **arrays)
+
+    def exportBytes(self):
+        """
+        Returns the npz export as bytes, for the server.
+        """
+        buffer = io.BytesIO()
+        self.export(buffer)
+        return buffer.getvalue()
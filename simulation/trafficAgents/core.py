@@ -0,0 +1,167 @@
+"""
+Minimal simulation core for the traffic model: agents, a random activation scheduler and a
+multi agent grid. It keeps the names and behavior of the parts of Mesa the model used
+(Agent, Model, RandomActivation, MultiGrid), so Mesa's ModularServer in webGUI.py can run the
+model as before, but headless runs (server, ensembles, tuning workers) don't import Mesa.
+
+The activation order is drawn from model.random exactly like Mesa does, so runs with the same
+seeds give the same results with either core.
+"""
+import random
+
+
+class Agent:
+    """
+    Base class for the agents, agents only keep their id, model and position.
+    """
+    __slots__ = ("unique_id", "model", "pos")
+
+    def __init__(self, unique_id, model):
+        self.unique_id = unique_id
+        self.model = model
+        self.pos = None
+
+    def step(self):
+        pass
+
+    @property
+    def random(self):
+        return self.model.random
+
+
+class Model:
+    """
+    Base class for the model, creates the random number generator of the model.
+    """
+    def __new__(cls, *args, **kwargs):
+        obj = object.__new__(cls)
+
+        # seeded from the global random module when no seed is given, like Mesa
+        obj._seed = kwargs.get("seed")
+        if obj._seed is None:
+            obj._seed = random.random()
+        obj.random = random.Random(obj._seed)
+
+        return obj
+
+    def __init__(self, *args, **kwargs):
+        self.running = True
+        self.schedule = None
+
+    def step(self):
+        pass
+
+    def reset_randomizer(self, seed=None):
+        """
+        Reseeds the random number generator of the model, with the last seed if none is given.
+        """
+        if seed is None:
+            seed = self._seed
+
+        self.random.seed(seed)
+        self._seed = seed
+
+
+class RandomActivation:
+    """
+    Activates every agent once per step, in a new random order every step.
+    Agents can be added and removed while the step runs, removed agents are not activated
+    and added agents wait for the next step.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.steps = 0
+        self.time = 0
+        self._agents = {}
+
+    def add(self, agent):
+        if agent.unique_id in self._agents:
+            raise ValueError(f"Agent with unique id {agent.unique_id!r} already added to the schedule")
+
+        self._agents[agent.unique_id] = agent
+
+    def remove(self, agent):
+        del self._agents[agent.unique_id]
+
+    def step(self):
+        agents = self._agents
+        keys = list(agents)
+        self.model.random.shuffle(keys)
+
+        for key in keys:
+            agent = agents.get(key)
+            if agent is not None:
+                agent.step()
+
+        self.steps += 1
+        self.time += 1
+
+    def get_agent_count(self):
+        return len(self._agents)
+
+    @property
+    def agents(self):
+        return list(self._agents.values())
+
+
+class MultiGrid:
+    """
+    Grid where each cell holds a list of agents, indexed grid[x][y] with (0, 0) at the bottom left.
+    """
+    def __init__(self, width, height, torus):
+        self.width = width
+        self.height = height
+        self.torus = torus
+        self._grid = [[[] for y in range(height)] for x in range(width)]
+
+    def __getitem__(self, x):
+        return self._grid[x]
+
+    def __iter__(self):
+        for column in self._grid:
+            yield from column
+
+    def coord_iter(self):
+        for x, column in enumerate(self._grid):
+            for y, cell in enumerate(column):
+                yield cell, (x, y)
+
+    def out_of_bounds(self, pos):
+        x, y = pos
+        return x < 0 or x >= self.width or y < 0 or y >= self.height
+
+    def torus_adj(self, pos):
+        if not self.out_of_bounds(pos):
+            return pos
+        elif not self.torus:
+            raise IndexError(f"Point {pos} out of bounds, and the grid is not toroidal")
+
+        return pos[0] % self.width, pos[1] % self.height
+
+    def place_agent(self, agent, pos):
+        x, y = pos
+        self._grid[x][y].append(agent)
+        agent.pos = pos
+
+    def remove_agent(self, agent):
+        x, y = agent.pos
+        self._grid[x][y].remove(agent)
+        agent.pos = None
+
+    def move_agent(self, agent, pos):
+        pos = self.torus_adj(pos)
+        self.remove_agent(agent)
+        self.place_agent(agent, pos)
+
+    def is_cell_empty(self, pos):
+        x, y = pos
+        return not self._grid[x][y]
+
+    def get_cell_list_contents(self, cells):
+        """
+        Returns the agents in the given cells, cells is a list of positions or a single position.
+        """
+        if isinstance(cells, tuple):
+            cells = [cells]
+
+        return [agent for x, y in cells for agent in self._grid[x][y]]
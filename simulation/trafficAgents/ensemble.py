@@ -0,0 +1,276 @@
+"""
+Monte Carlo ensemble runner for the traffic model.
+
+A single run is noisy (random spawns, destinations and activation order), so this
+runs independent replicates in a process pool and reports confidence intervals for
+throughput (finished cars per step) and trip time (steps from spawn to destination).
+
+Each replicate is split into batches of steps. The warm-up is truncated with MSER
+(marginal standard error rule) and the replicate stops as soon as the batch means
+after the warm-up are tight enough. The ensemble stops adding replicates once the
+intervals across replicates are tight enough, and replicates still running are told to
+stop at their next batch.
+
+Run it from the simulation folder:
+    python -m trafficAgents.ensemble --timeToSpawn 5 --spawnAmount 4
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from statistics import NormalDist
+
+from .model import TrafficModel
+
+# set by the ensemble once it converges, replicates still running in the pool stop at their next batch
+stopEvent = None
+
+
+def tQuantile(confidence, df):
+    """
+    Returns the two sided Student t critical value for the given confidence and degrees of freedom.
+    Uses the Cornish-Fisher expansion around the normal quantile, which is accurate to about 1% for df >= 3.
+    """
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    if df == math.inf:
+        return z
+
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+
+
+def confidenceInterval(values, confidence=0.95):
+    """
+    Returns (mean, halfWidth) of the confidence interval for the mean of the values.
+    The half width is infinite when there are less than two values.
+    """
+    n = len(values)
+    if n == 0:
+        return None, math.inf
+
+    mean = sum(values) / n
+    if n < 2:
+        return mean, math.inf
+
+    variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+    return mean, tQuantile(confidence, n - 1) * math.sqrt(variance / n)
+
+
+def relativeHalfWidth(mean, halfWidth):
+    """
+    Returns the half width relative to the mean, so the same precision works for any scale.
+    """
+    if halfWidth == 0:
+        return 0
+    if mean is None or mean == 0:
+        return math.inf
+
+    return halfWidth / abs(mean)
+
+
+def mserTruncation(values):
+    """
+    Returns how many of the first values are warm-up, using the marginal standard error rule.
+    Only the first half is considered, since truncating more than that makes the estimate unreliable.
+    """
+    n = len(values)
+
+    # suffix sums so every candidate truncation point is O(1)
+    suffixSum = [0] * (n + 1)
+    suffixSquares = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        suffixSum[i] = suffixSum[i + 1] + values[i]
+        suffixSquares[i] = suffixSquares[i + 1] + values[i] ** 2
+
+    best = 0
+    bestScore = math.inf
+    for d in range(n // 2 + 1):
+        remaining = n - d
+        mean = suffixSum[d] / remaining
+        score = (suffixSquares[d] - remaining * mean ** 2) / remaining ** 2
+
+        if score < bestScore:
+            best = d
+            bestScore = score
+
+    return best
+
+
+def runReplicate(seed, timeToSpawn, spawnAmount, maxSteps=1000, batchSize=20, minBatches=10, precision=0.05, confidence=0.95, modelKwargs=None, earlyStop=True, stop=None):
+    """
+    Runs a single replicate until its throughput reaches steady state or maxSteps is reached.
+    Args:
+        seed: seed for both the global random module (spawns, destinations) and the model's scheduler
+        timeToSpawn, spawnAmount: model parameters
+        maxSteps: hard limit of steps for the replicate
+        batchSize: steps per batch, batches are the unit used for warm-up truncation
+        minBatches: batches needed after the warm-up before the replicate can stop
+        precision: relative half width of the throughput interval needed to stop
+        confidence: confidence level of the interval
+        modelKwargs: extra keyword arguments for TrafficModel, congestion tracking is off unless they turn it on
+        earlyStop: stop when the throughput reaches steady state, otherwise always run maxSteps (or until gridlock)
+        stop: event checked every batch, the replicate is abandoned (returns None) when it's set
+    """
+    random.seed(seed)
+    model = TrafficModel(timeToSpawn, spawnAmount, sendsData=False, verbose=False, **{"trackCongestion": False, **(modelKwargs or {})})
+    model.reset_randomizer(seed)
+
+    # finished cars and the sum of their trip times per batch
+    batchFinished = []
+    batchTripTime = []
+    finished = 0
+    tripTime = 0
+
+    warmup = 0
+    steady = False
+    while model.running and model.steps < maxSteps:
+        model.step()
+        finished += len(model.finishedCars)
+        tripTime += sum(model.finishedTripTimes)
+
+        if model.steps % batchSize == 0:
+            if stop is not None and stop.is_set():
+                return None
+
+            batchFinished.append(finished)
+            batchTripTime.append(tripTime)
+            finished = 0
+            tripTime = 0
+
+            warmup = mserTruncation(batchFinished)
+            kept = batchFinished[warmup:]
+
+            if earlyStop and len(kept) >= minBatches and relativeHalfWidth(*confidenceInterval(kept, confidence)) <= precision:
+                steady = True
+                break
+
+    keptFinished = sum(batchFinished[warmup:])
+    keptTripTime = sum(batchTripTime[warmup:])
+    keptSteps = (len(batchFinished) - warmup) * batchSize
+
+    return {
+        "seed": seed,
+        "steps": model.steps,
+        "warmupSteps": warmup * batchSize,
+        "steady": steady,
+        # the model stops on its own when no cars can be spawned
+        "gridlocked": not model.running,
+        "finishedCars": model.totalFinishedCount,
+        "throughput": keptFinished / keptSteps if keptSteps else 0,
+        "tripTime": keptTripTime / keptFinished if keptFinished else None,
+    }
+
+
+def initWorker(event):
+    global stopEvent
+    stopEvent = event
+
+
+def runPooledReplicate(*args, **kwargs):
+    return runReplicate(*args, stop=stopEvent, **kwargs)
+
+
+def runEnsemble(timeToSpawn, spawnAmount, minReplicates=5, maxReplicates=50, precision=0.05, confidence=0.95, workers=None, baseSeed=0, **replicateKwargs):
+    """
+    Runs replicates in parallel until the throughput and trip time intervals are tight enough.
+    Args:
+        timeToSpawn, spawnAmount: model parameters
+        minReplicates: replicates needed before the ensemble can stop
+        maxReplicates: hard limit of replicates
+        precision: relative half width needed for both intervals
+        confidence: confidence level of the intervals
+        workers: processes in the pool, defaults to the number of CPUs
+        baseSeed: replicate i uses seed baseSeed + i
+        replicateKwargs: extra arguments for runReplicate
+    Replicates still running when the ensemble converges are abandoned, they are not in the results.
+    """
+    replicates = []
+    converged = False
+    workers = workers or os.cpu_count()
+    stop = multiprocessing.Event()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(stop,)) as pool:
+        # keep as many replicates in flight as there are workers
+        inFlight = set()
+        submitted = 0
+
+        def submit():
+            nonlocal submitted
+            inFlight.add(pool.submit(runPooledReplicate, baseSeed + submitted, timeToSpawn, spawnAmount, precision=precision, confidence=confidence, **replicateKwargs))
+            submitted += 1
+
+        for _ in range(min(workers, maxReplicates)):
+            submit()
+
+        while inFlight:
+            done, inFlight = wait(inFlight, return_when=FIRST_COMPLETED)
+            replicates.extend(future.result() for future in done)
+
+            summary = summarize(replicates, confidence)
+            if len(replicates) >= minReplicates and summary["throughput"]["relativeHalfWidth"] <= precision and summary["tripTime"]["relativeHalfWidth"] <= precision:
+                converged = True
+                stop.set()
+                break
+
+            while submitted < maxReplicates and len(inFlight) < workers:
+                submit()
+
+    summary = summarize(replicates, confidence)
+    summary["converged"] = converged
+    summary["replicates"] = sorted(replicates, key=lambda r: r["seed"])
+
+    return summary
+
+
+def summarize(replicates, confidence=0.95):
+    """
+    Returns the confidence intervals across replicates for throughput and trip time.
+    """
+    summary = {"count": len(replicates)}
+
+    for metric in ["throughput", "tripTime"]:
+        values = [r[metric] for r in replicates if r[metric] is not None]
+        mean, halfWidth = confidenceInterval(values, confidence)
+
+        summary[metric] = {
+            "mean": mean,
+            "halfWidth": halfWidth,
+            "relativeHalfWidth": relativeHalfWidth(mean, halfWidth),
+        }
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a Monte Carlo ensemble of the traffic model.")
+    parser.add_argument("--timeToSpawn", type=int, default=10)
+    parser.add_argument("--spawnAmount", type=int, default=4)
+    parser.add_argument("--minReplicates", type=int, default=5)
+    parser.add_argument("--maxReplicates", type=int, default=50)
+    parser.add_argument("--precision", type=float, default=0.05)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--maxSteps", type=int, default=1000)
+    parser.add_argument("--batchSize", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the full results as json to this file")
+    args = parser.parse_args()
+
+    results = runEnsemble(args.timeToSpawn, args.spawnAmount, args.minReplicates, args.maxReplicates, args.precision,
+                          args.confidence, args.workers, args.seed, maxSteps=args.maxSteps, batchSize=args.batchSize)
+
+    print("replicates: ", results["count"], "(converged)" if results["converged"] else "(not converged)")
+    for metric in ["throughput", "tripTime"]:
+        print(f"{metric}: {results[metric]['mean']} ± {results[metric]['halfWidth']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
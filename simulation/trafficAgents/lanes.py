@@ -0,0 +1,92 @@
+"""
+Lane level decision tables, built once from the map so the cars can move with table lookups
+and integer direction codes instead of comparing direction names and scanning the grid.
+"""
+
+# direction codes, lanes are named after directions too, so they share the codes
+UP, DOWN, LEFT, RIGHT = range(4)
+DIRECTIONS = ("up", "down", "left", "right")
+DIRECTION_CODES = {name: code for code, name in enumerate(DIRECTIONS)}
+
+# cell offset of moving one cell in each direction
+OFFSETS = ((0, 1), (0, -1), (-1, 0), (1, 0))
+
+# the other lane of a street, up <-> down and left <-> right
+OTHER_LANE = (DOWN, UP, RIGHT, LEFT)
+
+# where the other lane is, seen from a car in the given lane
+OTHER_LANE_OFFSETS = ((0, -1), (0, 1), (1, 0), (-1, 0))
+
+
+class LaneNetwork:
+    """
+    Per cell tables for the movement of the cars:
+        streetDirections: direction codes of the street in the cell (missing for stoplights, obstacles and destinations)
+        mainDirection: first direction of the street, the one cars follow outside nodes
+        stoplights: the stoplight agent in the cell
+        forward[cell][direction]: the next cell in that direction
+        laneChange[cell][direction][lane]: the cell a car going in direction ends in when it moves to lane
+        currentLane[cell][direction]: the lane a car going in direction is in
+        unstuckCells[cell][direction]: the three cells in front of the cell, inside the grid
+        nextNode[(node, direction)]: the node a car leaving the node in that direction drives to
+        streets, targets: cells with a street, cells with a destination
+    Args:
+        model: the TrafficModel, after populating the grid and reading the graph
+    """
+    def __init__(self, model):
+        from .agent import StoplightAgent, StreetAgent, TargetAgent
+
+        width = model.grid.width
+        height = model.grid.height
+
+        self.streetDirections = {}
+        self.mainDirection = {}
+        self.stoplights = {}
+        self.streets = set()
+        self.targets = set()
+
+        for x in range(width):
+            for y in range(height):
+                for agent in model.grid[x][y]:
+                    if isinstance(agent, StreetAgent):
+                        self.streetDirections[(x, y)] = tuple(DIRECTION_CODES[d] for d in agent.directions)
+                        self.mainDirection[(x, y)] = DIRECTION_CODES[agent.directions[0]]
+                        self.streets.add((x, y))
+                    elif isinstance(agent, StoplightAgent):
+                        self.stoplights[(x, y)] = agent
+                    elif isinstance(agent, TargetAgent):
+                        self.targets.add((x, y))
+
+        # cars keep to the lane by checking if there is more road to their side
+        drivable = self.streets | set(self.stoplights)
+
+        self.forward = {}
+        self.laneChange = {}
+        self.currentLane = {}
+        self.unstuckCells = {}
+
+        for x in range(width):
+            for y in range(height):
+                cell = (x, y)
+
+                self.forward[cell] = tuple((x + dx, y + dy) for dx, dy in OFFSETS)
+                self.laneChange[cell] = tuple(tuple((x + dx + lx, y + dy + ly) for lx, ly in OFFSETS) for dx, dy in OFFSETS)
+
+                vertical = LEFT if x + 1 < width and (x + 1, y) in drivable else RIGHT
+                horizontal = DOWN if y + 1 < height and (x, y + 1) in drivable else UP
+                self.currentLane[cell] = (vertical, vertical, horizontal, horizontal)
+
+                # the three cells in front, clipped to the grid
+                columns = range(max(x - 1, 0), min(x + 2, width))
+                rows = range(max(y - 1, 0), min(y + 2, height))
+                self.unstuckCells[cell] = (
+                    tuple((cx, y + 1) for cx in columns),
+                    tuple((cx, y - 1) for cx in columns),
+                    tuple((x - 1, cy) for cy in rows),
+                    tuple((x + 1, cy) for cy in rows),
+                )
+
+        self.nextNode = {}
+        for source, edges in model.adList.items():
+            for edge in edges:
+                self.nextNode.setdefault((source, edge["code"]), edge["to"])
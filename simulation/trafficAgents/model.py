@@ -1,12 +1,24 @@
 import os
 import random
 import json
-import requests
 
-from mesa import Model, agent
-from mesa.time import RandomActivation
-from mesa.space import MultiGrid
+from .core import Model, RandomActivation
 from .agent import CarAgent, ObstacleAgent, StoplightAgent, StreetAgent, TargetAgent
+from .analytics import TrackedMultiGrid, CongestionTracker
+from .lanes import DIRECTION_CODES, OFFSETS, LaneNetwork
+
+def loadMap(filename):
+    """
+    Given a filename relative to this folder, return the map as a list of rows of characters,
+    the first row is the bottom of the map so that rows can be indexed by y
+    """
+    rows = []
+    with open(os.path.join(os.path.dirname(__file__), filename), 'r') as f:
+        for line in f:
+            # insert at the beginning of the list so that the first line is at the top of the map
+            rows.insert(0, [*line.strip()])
+    
+    return rows
 
 class TrafficModel(Model):
     """ 
@@ -15,7 +27,10 @@ class TrafficModel(Model):
         N: Number of agents in the simulation
         height, width: The size of the grid to model
     """
-    def __init__(self, timeToSpawn, spawnAmount, sendsData = False):
+    mapFile = "maps/2023.txt"
+    graphFile = "maps/2023_Graph.json"
+    
+    def __init__(self, timeToSpawn, spawnAmount, sendsData = False, verbose = True, trackCongestion = True, congestionWindow = 100, timingPlan = None):
 
         # RandomActivation is a scheduler that activates each agent once per step, in random order.
         self.schedule = RandomActivation(self)
@@ -24,15 +39,32 @@ class TrafficModel(Model):
         
         self.destinations = []
 
-        self.readMap("maps/2023.txt")
+        self.readMap(self.mapFile)
         
         # Multigrid is a special type of grid where each cell can contain multiple agents.
-        self.grid = MultiGrid(len(self.map[0]), len(self.map), torus = False) 
+        # the tracked version lets the congestion analytics follow the cars as they move
+        self.grid = TrackedMultiGrid(len(self.map[0]), len(self.map), torus = False) 
         
         self.populateGrid()
-        self.readGraph("maps/2023_Graph.json")
+        self.groupStoplights()
+        self.readGraph(self.graphFile)
+        
+        # per cell lookup tables the cars use to move, see lanes.py
+        self.lanes = LaneNetwork(self)
+        
+        # stoplight timings found by the autotuner, see tuning.py
+        if timingPlan:
+            self.applyTimingPlan(timingPlan)
+        
+        # per cell and per edge congestion statistics, see analytics.py
+        self.congestion = CongestionTracker(self, congestionWindow) if trackCongestion else None
         
         self.carCount = 0
+        
+        # finished cars waiting to be reused, so long runs don't allocate a car and its buffers per trip
+        self.carPool = []
+        # template row for resetting the speed matrix of recycled cars
+        self.speedRow = [1] * (len(self.nodeToCells) + 1)
         self.spawnPoints = [(0, 0), (0, len(self.map)- 1), (len(self.map[0]) - 1, 0), (len(self.map[0]) - 1, len(self.map) - 1)]
         
         self.timeToSpawn = timeToSpawn
@@ -40,7 +72,8 @@ class TrafficModel(Model):
         self.timeSinceLastSpawn = 0
         
         self.finishedCars = [] # used by Unity to know which cars to remove, so it's reset every step
-        self.totalFinishedCars = [] # used by the server to know how many cars have finished
+        self.totalFinishedCount = 0 # used by the server to know how many cars have finished
+        self.finishedTripTimes = [] # steps each car in finishedCars took to arrive, also reset every step
         
         self.sendsData = sendsData
         self.timeToSendData = 100
@@ -49,16 +82,15 @@ class TrafficModel(Model):
         self.ep = "/attempts"
         self.steps = 0
         
+        # headless runs (ensembles, workers) turn this off to keep stdout quiet
+        self.verbose = verbose
+        
         
     def readMap(self, filename):
         """
         Given a filename, read the map
         """
-        self.map = []
-        with open(os.path.join(os.path.dirname(__file__), filename), 'r') as f:
-            for line in f:
-                # insert at the beginning of the list so that the first line is at the top of the map
-                self.map.insert(0, [*line.strip()])
+        self.map = loadMap(filename)
     
     def populateGrid(self):
         """
@@ -105,6 +137,87 @@ class TrafficModel(Model):
                 
                 self.grid.place_agent(agent, (w, h))
 
+    def groupStoplights(self):
+        """
+        Groups adjacent stoplights with the same direction, each group controls one street
+        of an intersection and is identified by the position of its first cell "x,y"
+        """
+        stoplights = {agent.pos: agent for agent in self.schedule.agents if isinstance(agent, StoplightAgent)}
+        
+        self.stoplightGroups = {}
+        seen = set()
+        for pos in sorted(stoplights):
+            if pos in seen:
+                continue
+            
+            # flood fill through neighboring stoplights of the same direction
+            group = []
+            pending = [pos]
+            seen.add(pos)
+            while pending:
+                cell = pending.pop()
+                group.append(stoplights[cell])
+                
+                for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
+                    neighbor = (cell[0] + dx, cell[1] + dy)
+                    if neighbor in stoplights and neighbor not in seen and stoplights[neighbor].direction == stoplights[pos].direction:
+                        seen.add(neighbor)
+                        pending.append(neighbor)
+            
+            self.stoplightGroups[f"{pos[0]},{pos[1]}"] = group
+        
+        self.groupIntersections()
+    
+    def groupIntersections(self):
+        """
+        Pairs the stoplight groups that control the two crossing streets of an intersection, their cells touch
+        diagonally. Each intersection is identified by the id of its first group and maps to the ids of its groups.
+        """
+        cells = {groupID: {stoplight.pos for stoplight in group} for groupID, group in self.stoplightGroups.items()}
+        
+        def touches(a, b):
+            return any(abs(x1 - x2) <= 1 and abs(y1 - y2) <= 1 for x1, y1 in cells[a] for x2, y2 in cells[b])
+        
+        self.intersections = {}
+        paired = set()
+        for groupID in self.stoplightGroups:
+            if groupID in paired:
+                continue
+            
+            paired.add(groupID)
+            groups = [groupID]
+            direction = self.stoplightGroups[groupID][0].direction
+            
+            for other in self.stoplightGroups:
+                if other not in paired and self.stoplightGroups[other][0].direction != direction and touches(groupID, other):
+                    paired.add(other)
+                    groups.append(other)
+                    break
+            
+            self.intersections[groupID] = groups
+    
+    def applyTimingPlan(self, plan):
+        """
+        Given a timing plan (a dictionary or the filename of a json file), set the cycle length and offset
+        of each intersection in it. Both streets of an intersection share the timing, since horizontal and
+        vertical stoplights start with opposite colors they stay in opposite phases.
+        Intersections not in the plan keep the default timing.
+        """
+        if isinstance(plan, str):
+            with open(plan, 'r') as f:
+                plan = json.load(f)
+        
+        if "intersections" not in plan:
+            raise ValueError("The timing plan has no intersections")
+        
+        for intersectionID, timing in plan["intersections"].items():
+            if intersectionID not in self.intersections:
+                raise ValueError(f"Unknown intersection {intersectionID}")
+            
+            for groupID in self.intersections[intersectionID]:
+                for stoplight in self.stoplightGroups[groupID]:
+                    stoplight.setTiming(timing["shiftIn"], timing.get("offset", 0))
+
     def readGraph(self, filename):
         """
         Given a filename, read the graph
@@ -123,9 +236,12 @@ class TrafficModel(Model):
             self.cellToNode = {}
             # dictionary mapping nodes to directions
             self.nodeToDirections = {}
+            # the same with the direction codes the cars use
+            self.nodeToDirectionCodes = {}
             
             for node in self.graph["nodes"]:
                 self.nodeToDirections[node["id"]] = node["directions"]
+                self.nodeToDirectionCodes[node["id"]] = [DIRECTION_CODES[d] for d in node["directions"]]
                 
                 self.nodeToCells[node["id"]] = [(cell["x"], cell["y"]) for cell in node["cells"]]
             
@@ -138,12 +254,224 @@ class TrafficModel(Model):
             for edge in self.graph["edges"]:
                 source = edge["from"]
                 edge.pop("from")
+                edge["code"] = DIRECTION_CODES[edge["direction"]]
                 
                 if source in self.adList:
                     self.adList[source].append(edge)
                 else:
                     self.adList[source] = [edge]
+            
+            self.findEdgeLanes()
+            
+    def findEdgeLanes(self):
+        """
+        Finds the street cells between the nodes of every edge, one list of cells per lane,
+        and prepares the closure state. adList always has every edge, since the cars use it to
+        know how the streets are connected. openAdList only has the edges that are not closed,
+        and is what the cars use to find their paths.
+        """
+        # (source, target) -> list of lanes, each one a list of cells going from source to target
+        self.edgeLanes = {}
+        # cell -> edges whose lanes go through it
+        self.cellToEdges = {}
+        # node -> edges that end in it
+        self.edgesInto = {}
+        
+        for source, edges in self.adList.items():
+            cells = set(self.nodeToCells[source])
+            
+            for edge in edges:
+                target = edge["to"]
+                dx, dy = OFFSETS[edge["code"]]
+                self.edgesInto.setdefault(target, []).append((source, target))
+                
+                lanes = []
+                for (x, y) in sorted(cells):
+                    x, y = x + dx, y + dy
+                    if (x, y) in cells:
+                        continue
+                    
+                    # walk the street until we reach the next node
+                    lane = []
+                    while 0 <= x < len(self.map[0]) and 0 <= y < len(self.map) and (x, y) not in self.cellToNode and self.map[y][x] not in "#D":
+                        lane.append((x, y))
+                        x, y = x + dx, y + dy
+                    
+                    # cells on the border of the node that face a wall are not lanes
+                    if self.cellToNode.get((x, y)) == target:
+                        lanes.append(lane)
+                        for cell in lane:
+                            self.cellToEdges.setdefault(cell, []).append((source, target))
                 
+                self.edgeLanes[(source, target)] = lanes
+        
+        self.closedCells = set()
+        # edges closed explicitly, edges can also be blocked by closed cells
+        self.closedEdges = set()
+        # edges that can't be used by the cars, either closed or blocked
+        self.blockedEdges = set()
+        self.openAdList = {source: list(edges) for source, edges in self.adList.items()}
+    
+    def isEdgeBlocked(self, source, target):
+        """
+        An edge is blocked if it was closed, if every one of its lanes has a closed cell,
+        or if every cell of one of its nodes is closed.
+        """
+        if (source, target) in self.closedEdges:
+            return True
+        
+        lanes = self.edgeLanes[(source, target)]
+        if lanes and all(any(cell in self.closedCells for cell in lane) for lane in lanes):
+            return True
+        
+        return any(all(cell in self.closedCells for cell in self.nodeToCells[node]) for node in (source, target))
+    
+    def updateClosures(self, edges):
+        """
+        Recalculates which of the given edges are blocked, updates openAdList only for their
+        source nodes, and reroutes the cars whose path goes through a newly blocked edge.
+        """
+        newlyBlocked = set()
+        sources = set()
+        
+        for edge in edges:
+            blocked = self.isEdgeBlocked(*edge)
+            
+            if blocked != (edge in self.blockedEdges):
+                sources.add(edge[0])
+                
+                if blocked:
+                    self.blockedEdges.add(edge)
+                    newlyBlocked.add(edge)
+                else:
+                    self.blockedEdges.discard(edge)
+        
+        for source in sources:
+            self.openAdList[source] = [edge for edge in self.adList[source] if (source, edge["to"]) not in self.blockedEdges]
+        
+        return {
+            "blockedEdges": sorted(self.blockedEdges),
+            "closedCells": sorted(self.closedCells),
+            "rerouted": self.rerouteCars(newlyBlocked),
+        }
+    
+    def rerouteCars(self, edges):
+        """
+        Generates a new path for every car whose path uses one of the given edges, returns how many were rerouted.
+        """
+        if not edges:
+            return 0
+        
+        # paths store (node, direction, nextTurn), so find the direction of each edge
+        turns = set()
+        for source, target in edges:
+            for edge in self.adList[source]:
+                if edge["to"] == target:
+                    turns.add((source, edge["code"]))
+        
+        rerouted = 0
+        for agent in self.schedule.agents:
+            if isinstance(agent, CarAgent) and agent.path and getattr(agent, "currNode", None) is not None:
+                if any(turn[:2] in turns for turn in agent.path):
+                    agent.generatePath()
+                    rerouted += 1
+        
+        return rerouted
+    
+    def affectedEdges(self, cells):
+        """
+        Returns the edges that go through, start or end in any of the cells.
+        """
+        edges = set()
+        for cell in cells:
+            edges.update(self.cellToEdges.get(cell, []))
+            
+            if cell in self.cellToNode:
+                node = self.cellToNode[cell]
+                edges.update((node, edge["to"]) for edge in self.adList.get(node, []))
+                edges.update(self.edgesInto.get(node, []))
+        
+        return edges
+    
+    def checkCells(self, cells):
+        """
+        Raises a ValueError if any of the cells is off the grid or is not a street or a stoplight
+        """
+        for cell in cells:
+            if len(cell) != 2 or not all(isinstance(value, int) for value in cell):
+                raise ValueError(f"Cell {list(cell)} is not a pair of integers")
+            
+            if self.grid.out_of_bounds(cell):
+                raise ValueError(f"Cell {list(cell)} is off the grid")
+            
+            if cell not in self.lanes.streets and cell not in self.lanes.stoplights:
+                raise ValueError(f"Cell {list(cell)} is not a street")
+    
+    def checkEdge(self, source, target):
+        """
+        Raises a ValueError if there is no edge from source to target
+        """
+        if (source, target) not in self.edgeLanes:
+            raise ValueError(f"There is no edge from {source} to {target}")
+    
+    def checkLane(self, source, target, lane):
+        """
+        Raises a ValueError if the edge doesn't exist or doesn't have the lane
+        """
+        self.checkEdge(source, target)
+        
+        lanes = self.edgeLanes[(source, target)]
+        if not isinstance(lane, int) or not 0 <= lane < len(lanes):
+            raise ValueError(f"The edge from {source} to {target} has no lane {lane}, it has {len(lanes)}")
+    
+    def closeCells(self, cells):
+        """
+        Closes the given cells, cars can't move into them
+        """
+        cells = [tuple(cell) for cell in cells]
+        self.checkCells(cells)
+        self.closedCells.update(cells)
+        return self.updateClosures(self.affectedEdges(cells))
+    
+    def reopenCells(self, cells):
+        """
+        Reopens the given cells
+        """
+        cells = [tuple(cell) for cell in cells]
+        self.checkCells(cells)
+        self.closedCells.difference_update(cells)
+        return self.updateClosures(self.affectedEdges(cells))
+    
+    def closeLane(self, source, target, lane):
+        """
+        Closes every cell of one lane of an edge, lanes are numbered in the order of edgeLanes
+        """
+        self.checkLane(source, target, lane)
+        return self.closeCells(self.edgeLanes[(source, target)][lane])
+    
+    def reopenLane(self, source, target, lane):
+        """
+        Reopens every cell of one lane of an edge
+        """
+        self.checkLane(source, target, lane)
+        return self.reopenCells(self.edgeLanes[(source, target)][lane])
+    
+    def closeEdge(self, source, target):
+        """
+        Closes an edge for routing, cars already on it can still drive through
+        """
+        self.checkEdge(source, target)
+        self.closedEdges.add((source, target))
+        return self.updateClosures([(source, target)])
+    
+    def reopenEdge(self, source, target):
+        """
+        Reopens an edge that was closed with closeEdge
+        """
+        self.checkEdge(source, target)
+        self.closedEdges.discard((source, target))
+        return self.updateClosures([(source, target)])
+        
 
     def step(self):
         '''Advance the model by one step.'''
@@ -165,9 +493,15 @@ class TrafficModel(Model):
         
         if self.running:
             self.finishedCars = []
+            self.finishedTripTimes = []
             self.schedule.step()
-            print("cars on the road: ", len([agent for agent in self.schedule.agents if isinstance(agent, CarAgent)]))
-            print("total finished cars: ", len(self.totalFinishedCars))
+            
+            if self.congestion:
+                self.congestion.stepEnded()
+            
+            if self.verbose:
+                print("cars on the road: ", len([agent for agent in self.schedule.agents if isinstance(agent, CarAgent)]))
+                print("total finished cars: ", self.totalFinishedCount)
             
         self.steps += 1
     
@@ -175,26 +509,53 @@ class TrafficModel(Model):
         spawnPointsCopy = self.spawnPoints.copy()
         
         carsSpawned = 0
+        # closed spawn points don't count towards a gridlock, they open again when the closure ends
+        openPoints = 0
         while len(spawnPointsCopy) and carsSpawned < self.spawnAmount:
             pos = random.choice(spawnPointsCopy)
             spawnPointsCopy.remove(pos)
+            if pos in self.closedCells:
+                continue
+            
+            openPoints += 1
             if not any(isinstance(agent, CarAgent) for agent in self.grid[pos[0]][pos[1]]):
-                car = CarAgent(f"car{self.carCount}", self, random.choice(self.destinations))
+                car = self.newCar(f"car{self.carCount}", random.choice(self.destinations))
                 self.carCount += 1
                 self.grid.place_agent(car, pos)
                 self.schedule.add(car)
                 carsSpawned += 1
         
-        if carsSpawned == 0:
-            print("No cars spawned")
+        if carsSpawned == 0 and openPoints > 0:
+            if self.verbose:
+                print("No cars spawned")
             self.running = False
             
+    def newCar(self, unique_id, destination):
+        """
+        Returns a car for a new trip, recycled from the pool when possible
+        """
+        if self.carPool:
+            car = self.carPool.pop()
+            car.reset(unique_id, destination)
+            return car
+        
+        return CarAgent(unique_id, self, destination)
+    
+    def recycleCar(self, car):
+        """
+        Keeps a finished car (already removed from the grid and the schedule) for reuse
+        """
+        self.carPool.append(car)
+        
     def sendData(self):
+        # only the runs that send data need requests, the rest don't import it
+        import requests
+        
         data = {
             "year": 2023,
             "classroom": 302,
             "name": "Mariel y Sant",
-            "num_cars": len(self.totalFinishedCars),
+            "num_cars": self.totalFinishedCount,
         }
         
         print("Sending data: ", data)
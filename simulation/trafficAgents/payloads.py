@@ -0,0 +1,142 @@
+"""
+Builds and encodes the payloads the servers send to the renderers.
+
+Three encodings are supported, chosen from the Accept header:
+    application/json: the format ModelController.cs reads
+    application/msgpack: same structure as json, smaller and faster to encode (needs msgpack installed)
+    application/octet-stream: packed little endian structs, a uint32 count followed by the records
+        cars: uint32 car number, int16 x, int16 z
+        stoplights: int16 x, int16 z, uint8 color (0 red, 1 green), uint8 direction (0 horizontal, 1 vertical)
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .agent import CarAgent, StoplightAgent
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+BINARY = "application/octet-stream"
+
+COUNT_STRUCT = struct.Struct("<I")
+CAR_STRUCT = struct.Struct("<Ihh")
+STOPLIGHT_STRUCT = struct.Struct("<hhBB")
+
+
+def parseAccept(accept):
+    """
+    Returns the media types of an Accept header with their quality, {mediaType: q}.
+    Entries with an invalid quality are ignored.
+    """
+    qualities = {}
+    for entry in (accept or "").split(","):
+        mediaType, *params = [part.strip() for part in entry.split(";")]
+        if not mediaType:
+            continue
+
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = None
+
+        if q is not None:
+            mediaType = mediaType.lower()
+            qualities[mediaType] = max(q, qualities.get(mediaType, 0))
+
+    return qualities
+
+
+def negotiate(accept, requested=None):
+    """
+    Returns the media type to answer with, given the Accept header and an optional explicit format
+    ("json", "msgpack" or "binary", usually from a query parameter).
+    The supported type with the highest quality wins, on a tie msgpack and binary are preferred over json.
+    Wildcards only stand for json. Falls back to json, which is what Unity asks for.
+    """
+    if requested:
+        requested = {"json": JSON, "msgpack": MSGPACK, "binary": BINARY}.get(requested)
+        if requested == MSGPACK and msgpack is None:
+            return JSON
+        return requested or JSON
+
+    qualities = parseAccept(accept)
+
+    candidates = {
+        BINARY: qualities.get(BINARY, 0),
+        JSON: qualities.get(JSON, max(qualities.get("application/*", 0), qualities.get("*/*", 0))),
+    }
+    if msgpack is not None:
+        candidates[MSGPACK] = max(qualities.get(MSGPACK, 0), qualities.get("application/x-msgpack", 0))
+
+    # in order of preference, max keeps the first of the best
+    best = max([MSGPACK, BINARY, JSON], key=lambda mediaType: candidates.get(mediaType, 0))
+    if candidates.get(best, 0) <= 0:
+        return JSON
+
+    return best
+
+
+def carNumber(carID):
+    """
+    Returns the number of a car id, ids are created as car{number} by the model.
+    """
+    return int(str(carID)[3:])
+
+
+def carPositions(model):
+    """
+    Returns (id, x, z) for every car on the grid.
+    """
+    return [(a.unique_id, a.pos[0], a.pos[1]) for a in model.schedule.agents if isinstance(a, CarAgent)]
+
+
+def finishedCars(model):
+    """
+    Returns (id, x, z) for every car that finished in the last step, position is always (0, 0).
+    """
+    return [(carID, 0, 0) for carID in model.finishedCars]
+
+
+def stopLights(model):
+    """
+    Returns (x, z, color, direction) for every stoplight.
+    """
+    return [(a.pos[0], a.pos[1], a.color, a.direction) for a in model.schedule.agents if isinstance(a, StoplightAgent)]
+
+
+def encodeCars(cars, mediaType):
+    """
+    Encodes a list of (id, x, z) as the body for /carPositions and /finishedCars.
+    """
+    if mediaType == BINARY:
+        return COUNT_STRUCT.pack(len(cars)) + b"".join(CAR_STRUCT.pack(carNumber(carID), x, z) for carID, x, z in cars)
+
+    return encodeObject({"positions": [{"id": str(carID), "x": x, "y": 1, "z": z} for carID, x, z in cars]}, mediaType)
+
+
+def encodeStopLights(stoplights, mediaType):
+    """
+    Encodes a list of (x, z, color, direction) as the body for /stopLightStatus.
+    """
+    if mediaType == BINARY:
+        return COUNT_STRUCT.pack(len(stoplights)) + b"".join(STOPLIGHT_STRUCT.pack(x, z, color == "green", direction == "vertical") for x, z, color, direction in stoplights)
+
+    return encodeObject({"stopLights": [{"id": str(x) + "," + str(z), "x": x, "y": 1, "z": z, "color": color, "direction": direction} for x, z, color, direction in stoplights]}, mediaType)
+
+
+def encodeObject(data, mediaType):
+    """
+    Encodes any other response (messages, counters) as json or msgpack, these have no packed struct layout.
+    """
+    if mediaType == MSGPACK:
+        return msgpack.packb(data)
+
+    return json.dumps(data, separators=(",", ":")).encode()
@@ -0,0 +1,252 @@
+"""
+Records runs of the traffic model to a file and reads them back, so a run can be viewed
+(and scrubbed) in Unity without simulating it again. See replayServer.py.
+
+File layout, all integers little endian:
+    header: b"TRAJ", uint32 version, uint32 length, json metadata (grid size, chunk size, stoplights, parameters)
+    chunks: zlib compressed groups of chunkSize consecutive frames
+    index: per chunk uint64 offset, uint32 length
+    footer: uint64 index offset, uint32 chunk count, uint32 frame count, b"TRJE"
+
+Inside a decompressed chunk there is a uint32 frame count, a uint32 offset per frame and the frames:
+    uint32 car count, then per car uint32 car number, int16 x, int16 z
+    uint32 spawned count, then uint32 car numbers
+    uint32 finished count, then uint32 car numbers
+    stoplight colors as a bitset (1 is green) in the order given by the header
+
+Frame i is the state after i steps, frame 0 is the state right after the model is created.
+
+Record a run from the simulation folder:
+    python -m trafficAgents.trajectory run.traj --steps 1000 --timeToSpawn 5 --spawnAmount 4
+"""
+import argparse
+import json
+import mmap
+import random
+import struct
+import zlib
+from collections import namedtuple
+from functools import lru_cache
+
+from .agent import CarAgent, StoplightAgent
+from .payloads import carNumber
+
+MAGIC = b"TRAJ"
+END_MAGIC = b"TRJE"
+VERSION = 1
+
+HEADER_STRUCT = struct.Struct("<4sII")
+INDEX_STRUCT = struct.Struct("<QI")
+FOOTER_STRUCT = struct.Struct("<QII4s")
+COUNT_STRUCT = struct.Struct("<I")
+CAR_STRUCT = struct.Struct("<Ihh")
+
+Frame = namedtuple("Frame", ["step", "cars", "spawned", "finished", "stoplights"])
+
+
+class TrajectoryRecorder:
+    """
+    Captures the state of a model once per call to record() and writes it in compressed chunks.
+    Args:
+        model: the TrafficModel to record
+        filename: file to write to
+        chunkSize: frames per compressed chunk, bigger chunks compress better but make seeking slower
+        params: extra metadata stored in the header (model parameters, seed...)
+    """
+    def __init__(self, model, filename, chunkSize=64, params=None):
+        self.model = model
+        self.chunkSize = chunkSize
+        self.file = open(filename, 'wb')
+
+        # the stoplights never move, so their order is fixed once and only colors are stored per frame
+        self.stoplights = [a for a in model.schedule.agents if isinstance(a, StoplightAgent)]
+
+        header = json.dumps({
+            "width": model.grid.width,
+            "height": model.grid.height,
+            "chunkSize": chunkSize,
+            "stoplights": [[a.pos[0], a.pos[1], a.direction] for a in self.stoplights],
+            "params": params or {},
+        }).encode()
+
+        self.file.write(HEADER_STRUCT.pack(MAGIC, VERSION, len(header)))
+        self.file.write(header)
+
+        self.index = []
+        self.frames = []
+        self.frameCount = 0
+        self.onGrid = set()
+
+    def record(self):
+        """
+        Captures the current state of the model as the next frame.
+        """
+        cars = [(carNumber(a.unique_id), a.pos[0], a.pos[1]) for a in self.model.schedule.agents if isinstance(a, CarAgent)]
+
+        onGrid = {car[0] for car in cars}
+        spawned = onGrid - self.onGrid
+        self.onGrid = onGrid
+
+        finished = [carNumber(carID) for carID in self.model.finishedCars] if self.frameCount else []
+
+        colors = bytearray((len(self.stoplights) + 7) // 8)
+        for i, stoplight in enumerate(self.stoplights):
+            if stoplight.color == "green":
+                colors[i // 8] |= 1 << (i % 8)
+
+        frame = [COUNT_STRUCT.pack(len(cars))]
+        frame.extend(CAR_STRUCT.pack(*car) for car in cars)
+        frame.append(struct.pack(f"<I{len(spawned)}I", len(spawned), *sorted(spawned)))
+        frame.append(struct.pack(f"<I{len(finished)}I", len(finished), *finished))
+        frame.append(bytes(colors))
+
+        self.frames.append(b"".join(frame))
+        self.frameCount += 1
+
+        if len(self.frames) == self.chunkSize:
+            self.writeChunk()
+
+    def writeChunk(self):
+        """
+        Compresses the pending frames and writes them as a chunk.
+        """
+        offsets = []
+        offset = COUNT_STRUCT.size * (len(self.frames) + 1)
+        for frame in self.frames:
+            offsets.append(offset)
+            offset += len(frame)
+
+        chunk = zlib.compress(struct.pack(f"<I{len(offsets)}I", len(offsets), *offsets) + b"".join(self.frames))
+
+        self.index.append((self.file.tell(), len(chunk)))
+        self.file.write(chunk)
+        self.frames = []
+
+    def close(self):
+        """
+        Writes the remaining frames, the index and the footer.
+        """
+        if self.frames:
+            self.writeChunk()
+
+        indexOffset = self.file.tell()
+        for entry in self.index:
+            self.file.write(INDEX_STRUCT.pack(*entry))
+
+        self.file.write(FOOTER_STRUCT.pack(indexOffset, len(self.index), self.frameCount, END_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TrajectoryReader:
+    """
+    Reads a recorded run with random access by step. The file is memory mapped and only
+    the chunks that are used get decompressed, the most recent ones are cached.
+    Args:
+        filename: file written by a TrajectoryRecorder
+        cacheSize: decompressed chunks kept in memory
+    """
+    def __init__(self, filename, cacheSize=8):
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, headerLength = HEADER_STRUCT.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{filename} is not a trajectory file")
+
+        self.header = json.loads(self.data[HEADER_STRUCT.size:HEADER_STRUCT.size + headerLength])
+        self.chunkSize = self.header["chunkSize"]
+        self.stoplights = self.header["stoplights"]
+
+        indexOffset, chunkCount, self.frameCount, endMagic = FOOTER_STRUCT.unpack_from(self.data, len(self.data) - FOOTER_STRUCT.size)
+        if endMagic != END_MAGIC:
+            raise ValueError(f"{filename} was not closed properly")
+
+        self.index = [INDEX_STRUCT.unpack_from(self.data, indexOffset + i * INDEX_STRUCT.size) for i in range(chunkCount)]
+
+        self.chunk = lru_cache(maxsize=cacheSize)(self.readChunk)
+
+    def __len__(self):
+        return self.frameCount
+
+    def readChunk(self, i):
+        """
+        Returns the decompressed chunk i.
+        """
+        offset, length = self.index[i]
+        return zlib.decompress(self.data[offset:offset + length])
+
+    def frame(self, step):
+        """
+        Returns the Frame for the given step, car ids are returned as the model creates them.
+        """
+        if not 0 <= step < self.frameCount:
+            raise IndexError(f"step {step} is out of range, the trajectory has {self.frameCount} frames")
+
+        chunk = self.chunk(step // self.chunkSize)
+        offset, = COUNT_STRUCT.unpack_from(chunk, COUNT_STRUCT.size * (step % self.chunkSize + 1))
+
+        count, = COUNT_STRUCT.unpack_from(chunk, offset)
+        offset += COUNT_STRUCT.size
+        cars = [(f"car{number}", x, z) for number, x, z in CAR_STRUCT.iter_unpack(chunk[offset:offset + count * CAR_STRUCT.size])]
+        offset += count * CAR_STRUCT.size
+
+        lists = []
+        for _ in range(2):
+            count, = COUNT_STRUCT.unpack_from(chunk, offset)
+            offset += COUNT_STRUCT.size
+            lists.append([f"car{number}" for number in struct.unpack_from(f"<{count}I", chunk, offset)])
+            offset += count * COUNT_STRUCT.size
+
+        stoplights = []
+        for i, (x, z, direction) in enumerate(self.stoplights):
+            color = "green" if chunk[offset + i // 8] & (1 << (i % 8)) else "red"
+            stoplights.append((x, z, color, direction))
+
+        return Frame(step, cars, lists[0], lists[1], stoplights)
+
+    def close(self):
+        self.chunk.cache_clear()
+        self.data.close()
+        self.file.close()
+
+
+def recordRun(filename, steps, timeToSpawn, spawnAmount, seed=None, chunkSize=64):
+    """
+    Runs a model for the given steps (or until it stops) and records it.
+    """
+    from .model import TrafficModel
+
+    random.seed(seed)
+    # the recording doesn't have the heatmap, so don't pay for tracking it
+    model = TrafficModel(timeToSpawn, spawnAmount, sendsData=False, verbose=False, trackCongestion=False)
+    model.reset_randomizer(seed)
+
+    params = {"timeToSpawn": timeToSpawn, "spawnAmount": spawnAmount, "seed": seed}
+    with TrajectoryRecorder(model, filename, chunkSize, params) as recorder:
+        recorder.record()
+
+        while model.running and model.steps < steps:
+            model.step()
+            recorder.record()
+
+    return model.steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record a run of the traffic model for replayServer.py.")
+    parser.add_argument("filename")
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--timeToSpawn", type=int, default=10)
+    parser.add_argument("--spawnAmount", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--chunkSize", type=int, default=64)
+    args = parser.parse_args()
+
+    steps = recordRun(args.filename, args.steps, args.timeToSpawn, args.spawnAmount, args.seed, args.chunkSize)
+    print(f"Recorded {steps} steps to {args.filename}")
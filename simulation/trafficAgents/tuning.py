@@ -0,0 +1,155 @@
+"""
+Autotuner for stoplight timing (cycle length and offset per intersection) and,
+optionally, the demand parameters (timeToSpawn, spawnAmount).
+
+Candidates are sampled at random and evaluated with successive halving: every round all
+surviving candidates run for a short budget of steps in a process pool, only the best
+1/eta are kept, and the budget is multiplied by eta. Bad candidates are discarded after
+a short run and only the promising ones get long runs.
+
+The result is a timing plan json that the model loads with TrafficModel(..., timingPlan=filename).
+
+Run it from the simulation folder:
+    python -m trafficAgents.tuning plan.json --objective finished --candidates 27
+"""
+import argparse
+import json
+import math
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from .ensemble import runReplicate
+from .model import TrafficModel
+
+
+def defaultPlan(intersections, shiftIn=10):
+    """
+    Returns the plan matching the hardcoded timing, every intersection with the same cycle and no offset.
+    """
+    return {"intersections": {intersection: {"shiftIn": shiftIn, "offset": 0} for intersection in intersections}}
+
+
+def samplePlan(intersections, rng, minCycle, maxCycle):
+    """
+    Returns a random plan, offsets go over the whole cycle (both colors).
+    """
+    plan = {"intersections": {}}
+    for intersection in intersections:
+        shiftIn = rng.randint(minCycle, maxCycle)
+        plan["intersections"][intersection] = {"shiftIn": shiftIn, "offset": rng.randrange(2 * shiftIn)}
+
+    return plan
+
+
+def evaluate(plan, demand, steps, seeds, objective):
+    """
+    Runs the candidate once per seed for the given steps and returns its score, lower is better.
+    Args:
+        plan: timing plan for the model
+        demand: dictionary with timeToSpawn and spawnAmount
+        steps: steps per run
+        seeds: seeds of the runs, the same for every candidate so they face the same randomness
+        objective: "finished" maximizes the finished cars, "tripTime" minimizes the mean trip time
+    """
+    scores = []
+    for seed in seeds:
+        # no early stop, every candidate gets the same budget
+        result = runReplicate(seed, demand["timeToSpawn"], demand["spawnAmount"], maxSteps=steps, modelKwargs={"timingPlan": plan, "trackCongestion": False}, earlyStop=False)
+
+        if objective == "finished":
+            scores.append(-result["finishedCars"])
+        elif result["gridlocked"] or result["tripTime"] is None:
+            # a gridlocked run only has the trip times of the few cars that made it
+            scores.append(math.inf)
+        else:
+            scores.append(result["tripTime"])
+
+    return sum(scores) / len(scores)
+
+
+def evaluateCandidate(args):
+    return evaluate(*args)
+
+
+def tune(objective="finished", candidates=27, eta=3, minSteps=100, maxSteps=900, seeds=2, minCycle=4, maxCycle=20,
+         demand=None, tuneDemand=False, maxTimeToSpawn=20, workers=None, seed=0):
+    """
+    Searches for the best timing plan with successive halving.
+    Args:
+        objective: "finished" or "tripTime"
+        candidates: plans sampled, the first one is always the default timing
+        eta: every round keeps 1/eta of the candidates and multiplies the budget by eta
+        minSteps, maxSteps: budget of the first round, and the limit of the budget
+        seeds: runs per candidate in every round
+        minCycle, maxCycle: range of the steps a stoplight keeps each color
+        demand: timeToSpawn and spawnAmount used when the demand is not tuned
+        tuneDemand: also sample timeToSpawn (1 to maxTimeToSpawn) and spawnAmount (1 to 4)
+        workers: processes in the pool, defaults to the number of CPUs
+        seed: seed of the sampling
+    """
+    rng = random.Random(seed)
+    demand = demand or {"timeToSpawn": 10, "spawnAmount": 4}
+    intersections = list(TrafficModel(1, 1, verbose=False, trackCongestion=False).intersections)
+
+    pool = [(defaultPlan(intersections), dict(demand))]
+    while len(pool) < candidates:
+        candidateDemand = {"timeToSpawn": rng.randint(1, maxTimeToSpawn), "spawnAmount": rng.randint(1, 4)} if tuneDemand else dict(demand)
+        pool.append((samplePlan(intersections, rng, minCycle, maxCycle), candidateDemand))
+
+    runSeeds = [seed + i for i in range(seeds)]
+    steps = minSteps
+    rounds = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            scores = list(executor.map(evaluateCandidate, [(plan, candidateDemand, steps, runSeeds, objective) for plan, candidateDemand in pool]))
+            ranked = sorted(zip(scores, range(len(pool))))
+            rounds.append({"steps": steps, "candidates": len(pool), "best": -ranked[0][0] if objective == "finished" else ranked[0][0]})
+
+            if len(pool) == 1 or steps >= maxSteps:
+                break
+
+            keep = max(1, math.ceil(len(pool) / eta))
+            pool = [pool[i] for _, i in ranked[:keep]]
+            steps = min(maxSteps, steps * eta)
+
+    score, best = ranked[0]
+    plan, bestDemand = pool[best]
+
+    plan["demand"] = bestDemand
+    plan["objective"] = objective
+    # the score is negated for the finished objective, so store it the way it reads
+    plan["score"] = -score if objective == "finished" else score
+    plan["steps"] = steps
+    plan["rounds"] = rounds
+
+    return plan
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tune stoplight timings and demand parameters of the traffic model.")
+    parser.add_argument("output", help="json file to write the timing plan to")
+    parser.add_argument("--objective", choices=["finished", "tripTime"], default="finished")
+    parser.add_argument("--candidates", type=int, default=27)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--minSteps", type=int, default=100)
+    parser.add_argument("--maxSteps", type=int, default=900)
+    parser.add_argument("--seeds", type=int, default=2)
+    parser.add_argument("--minCycle", type=int, default=4)
+    parser.add_argument("--maxCycle", type=int, default=20)
+    parser.add_argument("--timeToSpawn", type=int, default=10)
+    parser.add_argument("--spawnAmount", type=int, default=4)
+    parser.add_argument("--tuneDemand", action="store_true")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    plan = tune(args.objective, args.candidates, args.eta, args.minSteps, args.maxSteps, args.seeds, args.minCycle, args.maxCycle,
+                {"timeToSpawn": args.timeToSpawn, "spawnAmount": args.spawnAmount}, args.tuneDemand, workers=args.workers, seed=args.seed)
+
+    for r in plan["rounds"]:
+        print(f"{r['candidates']} candidates, {r['steps']} steps, best score {r['best']}")
+    print(f"{args.objective}: {plan['score']}, demand: {plan['demand']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(plan, f, indent=4)
@@ -1,4 +1,7 @@
-from trafficAgents.model import TrafficModel
+import os
+from collections import defaultdict
+
+from trafficAgents.model import TrafficModel, loadMap
 from trafficAgents.agent import CarAgent, ObstacleAgent, StoplightAgent, StreetAgent, TargetAgent
 from mesa.visualization import CanvasGrid, BarChartModule, PieChartModule
 from mesa.visualization import ModularServer
@@ -46,8 +49,74 @@ def agent_portrayal(agent):
 
     return portrayal
 
-W = 24
-H = 25
+class StaticCanvasGrid(CanvasGrid):
+    """
+    CanvasGrid that portrays the static agents (obstacles, streets and destinations) once per map
+    and sends them only when the model changes. Every other frame only portrays the scheduled agents
+    (cars and stoplights), instead of every agent in every cell.
+    """
+    package_includes = ["GridDraw.js", "InteractionHandler.js"]
+    local_includes = ["StaticCanvasModule.js"]
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    def __init__(self, portrayal_method, grid_width, grid_height, canvas_width=500, canvas_height=500):
+        super().__init__(portrayal_method, grid_width, grid_height, canvas_width, canvas_height)
+        self.js_code = f"elements.push(new StaticCanvasModule({canvas_width}, {canvas_height}, {grid_width}, {grid_height}));"
+        
+        # static layers for each map file, and the model they were last sent for
+        self.staticStates = {}
+        self.lastModel = None
+        
+    def renderStatic(self, model):
+        """
+        Portrays every agent that is not in the schedule, these never move or change.
+        """
+        scheduled = {id(agent) for agent in model.schedule.agents}
+        
+        state = defaultdict(list)
+        for x in range(model.grid.width):
+            for y in range(model.grid.height):
+                for agent in model.grid[x][y]:
+                    if id(agent) in scheduled:
+                        continue
+                    
+                    portrayal = self.portrayal_method(agent)
+                    if portrayal:
+                        portrayal["x"] = x
+                        portrayal["y"] = y
+                        state[portrayal["Layer"]].append(portrayal)
+        
+        return state
+    
+    def render(self, model):
+        staticState = None
+        
+        # a new model (reset or a new page) needs the terrain again
+        if model is not self.lastModel:
+            self.lastModel = model
+            
+            if model.mapFile not in self.staticStates:
+                self.staticStates[model.mapFile] = self.renderStatic(model)
+                
+            staticState = self.staticStates[model.mapFile]
+        
+        dynamicState = defaultdict(list)
+        for agent in model.schedule.agents:
+            portrayal = self.portrayal_method(agent)
+            if portrayal:
+                portrayal["x"] = agent.pos[0]
+                portrayal["y"] = agent.pos[1]
+                dynamicState[portrayal["Layer"]].append(portrayal)
+        
+        return {"static": staticState, "dynamic": dynamicState}
+
+# the size of the grid comes from the map the model loads
+mapRows = loadMap(TrafficModel.mapFile)
+W = len(mapRows[0])
+H = len(mapRows)
+
+# pixels per cell, smaller for big maps so the canvas fits on screen
+cellSize = max(4, min(20, 1000 // max(W, H)))
 
 model_params = {
     "timeToSpawn": Slider("Time to Spawn", 10, 1, 50, 1),
@@ -55,7 +124,7 @@ model_params = {
     "sendsData": Checkbox("Sends Data", False)
 }
 
-grid = CanvasGrid(agent_portrayal, W, H, W*20, H*20)
+grid = StaticCanvasGrid(agent_portrayal, W, H, W*cellSize, H*cellSize)
 
 server = ModularServer(TrafficModel, [grid], "Random Agents", model_params)
                        